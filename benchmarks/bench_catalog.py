@@ -0,0 +1,86 @@
+"""Memory held by an in-memory catalog: plain dict records against ImageRecord.
+
+    python benchmarks/bench_catalog.py --images 200000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import waifu_gallery
+
+TAGS = [f"tag{i}" for i in range(300)]
+
+def make_library(count, rng, tagged_share=0.5):
+    # Index rows the way SQLite hands them out, plus image_info for a share of them
+    rows = []
+    image_info = {}
+    for i in range(count):
+        filename = f"folder{i % 50}/image_{i:07d}_{rng.getrandbits(32):08x}.png"
+        rows.append({'filename': filename, 'width': rng.choice([800, 1200, 1920, 2480]), 'height': rng.choice([600, 1080, 3508]),
+                     'size': rng.randint(10000, 9000000), 'mtime_ns': 1700000000000000000 + rng.getrandbits(40), 'inode': 1000000 + i,
+                     'orientation': None})
+        if rng.random() < tagged_share:
+            image_info[filename] = {'info': '', 'source': '', 'tags': ', '.join(rng.sample(TAGS, rng.randint(1, 8)))}
+    return rows, image_info
+
+def make_dict_record(image_id, entry, image_info):
+    # The representation the catalog used before ImageRecord: a dict per image
+    # with its display fields computed up front and its tags split afresh
+    info = image_info.get(image_id, {})
+    return {
+        'original': image_id,
+        'shortened': waifu_gallery.shorten_filename(os.path.basename(entry['filename'])),
+        'info': info.get('info', ''),
+        'source': info.get('source', ''),
+        'tags': waifu_gallery.parse_tags(info.get('tags', '')),
+        'dimensions': waifu_gallery.format_dimensions(entry['width'], entry['height']),
+        'width': entry['width'],
+        'height': entry['height'],
+        'modified': entry['mtime_ns'] / 1e9,
+        'version': waifu_gallery.get_file_version(entry['size'], entry['mtime_ns'], entry['inode'])
+    }
+
+def measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    catalog = build()
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return catalog, size, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=200000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    rows, image_info = make_library(args.images, rng)
+    # Built outside the measurement: the tag index exists either way
+    image_tags = waifu_gallery.get_tags_by_image(image_info)
+
+    results = {}
+    dicts, results['dict'], build_dicts = measure(
+        lambda: [make_dict_record(row['filename'], row, image_info) for row in rows])
+    records, results['ImageRecord'], build_records = measure(
+        lambda: [waifu_gallery.make_image_record(row['filename'], row, image_info, image_tags) for row in rows])
+    assert [record.as_dict() for record in records] == dicts
+
+    start = time.perf_counter()
+    for record in records:
+        record.as_dict()
+    serialize = time.perf_counter() - start
+
+    print(f"{'records':>12} {'MiB':>8} {'bytes/image':>12} {'build s':>8}")
+    for name, size, elapsed in (('dict', results['dict'], build_dicts), ('ImageRecord', results['ImageRecord'], build_records)):
+        print(f"{name:>12} {size / 2**20:>8.1f} {size / args.images:>12.0f} {elapsed:>8.2f}")
+    print(f"ImageRecord uses {results['ImageRecord'] / results['dict']:.0%} of the memory; "
+          f"as_dict() for all {args.images} images takes {serialize:.2f} s")
+
+if __name__ == '__main__':
+    main()
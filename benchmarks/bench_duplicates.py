@@ -0,0 +1,93 @@
+"""Near-duplicate search over synthetic perceptual hashes, against brute force.
+
+    python benchmarks/bench_duplicates.py --hashes 100000 --distance 4 6 8 10
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import waifu_gallery
+from corpus import generate_corpus
+
+def make_hashes(count, rng, duplicate_share=0.1, max_flips=5):
+    # Random 64-bit hashes, a share of which are copies of an earlier hash
+    # with a few bits flipped, the way a re-encoded or resized copy would be
+    hashes = {}
+    values = []
+    for i in range(count):
+        if values and rng.random() < duplicate_share:
+            value = rng.choice(values)
+            for bit in rng.sample(range(64), rng.randint(0, max_flips)):
+                value ^= 1 << bit
+        else:
+            value = rng.getrandbits(64)
+        values.append(value)
+        hashes[f"image_{i:07d}.png"] = value
+    return hashes
+
+def brute_force_pairs(hashes, max_distance):
+    items = list(hashes.items())
+    pairs = 0
+    for i, (_, value) in enumerate(items):
+        for _, other in items[i + 1:]:
+            if (value ^ other).bit_count() <= max_distance:
+                pairs += 1
+    return pairs
+
+def clustered_pairs(clusters, hashes, max_distance):
+    pairs = 0
+    for cluster in clusters:
+        for i, image_id in enumerate(cluster):
+            for other in cluster[i + 1:]:
+                if (hashes[image_id] ^ hashes[other]).bit_count() <= max_distance:
+                    pairs += 1
+    return pairs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hashes', type=int, default=100000)
+    parser.add_argument('--distance', type=int, nargs='+', default=[4, 6, 8, 10])
+    parser.add_argument('--sample', type=int, default=3000, help="hashes checked against brute force")
+    parser.add_argument('--images', type=int, default=200, help="images hashed to measure hashing throughput")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    hashes = make_hashes(args.hashes, rng)
+    sample = dict(list(hashes.items())[:args.sample])
+
+    print(f"{'distance':>8} {'clusters':>9} {'images':>8} {'search s':>9} {'sample ok':>10} {'brute s (est.)':>15}")
+    for distance in args.distance:
+        start = time.perf_counter()
+        clusters = waifu_gallery.find_duplicate_clusters(hashes, distance)
+        elapsed = time.perf_counter() - start
+
+        # Every pair within distance in the sample has to end up in one cluster
+        start = time.perf_counter()
+        expected = brute_force_pairs(sample, distance)
+        brute = time.perf_counter() - start
+        found = clustered_pairs(waifu_gallery.find_duplicate_clusters(sample, distance), sample, distance)
+        estimate = brute * (args.hashes / args.sample) ** 2
+        print(f"{distance:>8} {len(clusters):>9} {sum(map(len, clusters)):>8} {elapsed:>9.2f} {str(found == expected):>10} {estimate:>15.0f}")
+
+    work_dir = tempfile.mkdtemp(prefix='gallery-bench-')
+    try:
+        image_dir = os.path.join(work_dir, 'images')
+        filenames = generate_corpus(image_dir, args.images)
+        paths = [os.path.join(image_dir, filename) for filename in filenames]
+        start = time.perf_counter()
+        for path in paths:
+            waifu_gallery.hash_image(path)
+        elapsed = time.perf_counter() - start
+        engine = 'numpy' if waifu_gallery.numpy is not None else 'pure python'
+        print(f"hashing: {args.images / elapsed:.0f} images/s on one thread ({engine} DCT)")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
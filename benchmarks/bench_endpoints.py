@@ -0,0 +1,354 @@
+"""Latency and throughput of the gallery endpoints at several library sizes, saved as JSON.
+
+    python benchmarks/bench_endpoints.py --images 1000 10000 100000 --output results.json
+    python benchmarks/bench_endpoints.py --images 1000 10000 --output new.json --compare results.json
+
+For every library size a synthetic corpus is generated (or reused from
+--corpus-dir) and measured in a fresh process: a cold scan into an empty
+index, a warm rescan, every endpoint through Flask's test client, and then
+the same endpoints against a real server started on that index. Peak RSS is
+taken for the measuring process and for the server. --compare prints how each
+number moved against an earlier run and exits with status 1 when anything got
+slower by more than --threshold.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import threading
+import http.client
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+try:
+    import resource
+except ImportError:
+    # Peak RSS is then reported as null
+    resource = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from corpus import FORMATS, generate_corpus, generate_image_info
+
+# Stats where a larger number is better; for the rest smaller is better
+HIGHER_IS_BETTER = ('requests_per_second',)
+COMPARED_STATS = ('requests_per_second', 'p50_ms', 'p95_ms', 'cold_list_seconds', 'cold_probe_seconds', 'warm_seconds',
+                  'peak_rss_mib', 'server_peak_rss_mib')
+
+def get_endpoints(image_ids, page_size):
+    # (name, function from request number to method, path and JSON body) per
+    # endpoint. Requests for single images go round the first hundred, so they
+    # do not all hit the same file.
+    ids = image_ids[:100]
+    return [
+        ('/', lambda i: ('GET', '/', None)),
+        ('/get_images', lambda i: ('GET', f'/get_images?limit={page_size}', None)),
+        ('/get_images?stream=1', lambda i: ('GET', f'/get_images?stream=1&limit={page_size}', None)),
+        ('/check_updates', lambda i: ('GET', '/check_updates', None)),
+        ('/images/<filename>', lambda i: ('GET', f'/images/{quote(ids[i % len(ids)])}', None)),
+        ('/save_image_info', lambda i: ('POST', '/save_image_info', {
+            'image_id': ids[i % len(ids)], 'info': f"benchmark {i}", 'source': '', 'tags': 'tag0, tag1'}))
+    ]
+
+def summarize(latencies, errors, elapsed, first=None):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3) if latencies else None
+
+    stats = {
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99)
+    }
+    if first is not None:
+        stats['first_ms'] = round(first * 1000, 3)
+    return stats
+
+def send(client, make_request, i):
+    method, path, body = make_request(i)
+    start = time.perf_counter()
+    response = client.open(path, method=method, json=body)
+    response.get_data()
+    return time.perf_counter() - start, response.status_code < 400
+
+def drive_test_client(client, make_request, count):
+    # One request that finds the endpoint's caches cold, then count more in a row
+    first, ok = send(client, make_request, 0)
+    latencies = []
+    errors = 0 if ok else 1
+    start = time.perf_counter()
+    for i in range(1, count + 1):
+        elapsed, ok = send(client, make_request, i)
+        if ok:
+            latencies.append(elapsed)
+        else:
+            errors += 1
+    return summarize(latencies, errors, time.perf_counter() - start, first)
+
+def drive_server(port, make_request, concurrency, duration):
+    # concurrency keep-alive connections sending requests back to back
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    counter = iter(range(10**9))
+
+    def worker():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        while time.perf_counter() < deadline:
+            method, path, body = make_request(next(counter))
+            headers = {}
+            if body is not None:
+                body = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                errors.append(1)
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                continue
+            if response.status >= 400:
+                errors.append(response.status)
+            else:
+                latencies.append(time.perf_counter() - start)
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, len(errors), time.perf_counter() - start)
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_server(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"the server exited with status {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/check_updates')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("the server did not start in time")
+
+def get_peak_rss_mib(children=False):
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+def measure_library(args):
+    # Runs in its own process, so that peak RSS belongs to this library alone;
+    # the gallery is only imported here for the same reason
+    import waifu_gallery
+
+    library, output = args.measure
+    filenames = sorted(name for name in os.listdir(library) if name.lower().endswith(waifu_gallery.IMAGE_EXTENSIONS))
+    image_info = generate_image_info(filenames, args.tag_density)
+    settings_dir = tempfile.mkdtemp(prefix='gallery-bench-')
+    try:
+        waifu_gallery.SETTINGS_DIR = settings_dir
+        waifu_gallery.BACKGROUND_JOBS = False
+        waifu_gallery.index_ready = False
+        waifu_gallery.update_config(lambda config: config.update(image_directory=library, image_info=image_info))
+        waifu_gallery.flush_config()
+
+        # Scanning only lists files and queues them for the probe job, so the
+        # two are timed apart; the warm rescan finds every folder unchanged
+        start = time.perf_counter()
+        waifu_gallery.get_images_from_directory(library, image_info)
+        cold_list = time.perf_counter() - start
+        start = time.perf_counter()
+        while waifu_gallery.probe_pending_images([library]):
+            pass
+        cold_probe = time.perf_counter() - start
+        start = time.perf_counter()
+        waifu_gallery.get_images_from_directory(library, image_info)
+        warm = time.perf_counter() - start
+        result = {
+            'images': len(filenames),
+            'tagged_images': len(image_info),
+            'scan': {
+                'cold_list_seconds': round(cold_list, 4),
+                'cold_probe_seconds': round(cold_probe, 4),
+                'warm_seconds': round(warm, 4)
+            }
+        }
+
+        endpoints = get_endpoints(filenames, waifu_gallery.PAGE_SIZE)
+        client = waifu_gallery.app.test_client()
+        result['test_client'] = {name: drive_test_client(client, make_request, args.requests)
+                                 for name, make_request in endpoints}
+        waifu_gallery.flush_config()
+        result['peak_rss_mib'] = get_peak_rss_mib()
+
+        if args.server != 'none':
+            port = get_free_port()
+            command = [sys.executable, os.path.join(REPO_DIR, 'waifu_gallery.py'), '--settings-dir', settings_dir,
+                       '--port', str(port), '--threads', str(args.threads), '--server', args.server]
+            server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for_server(port, server)
+                result['server'] = {name: drive_server(port, make_request, args.concurrency, args.duration)
+                                    for name, make_request in endpoints}
+            finally:
+                server.terminate()
+                server.wait()
+            result['server_peak_rss_mib'] = get_peak_rss_mib(children=True)
+    finally:
+        shutil.rmtree(settings_dir, ignore_errors=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+def prepare_corpus(corpus_dir, count, args):
+    # A directory is reused when it holds as many images as asked for, so the
+    # slow part of a 100k run only happens once with --corpus-dir
+    library = os.path.join(corpus_dir, f"{count}-{'-'.join(args.formats)}")
+    if os.path.isdir(library) and len(os.listdir(library)) == count:
+        return library
+    shutil.rmtree(library, ignore_errors=True)
+    start = time.perf_counter()
+    generate_corpus(library, count, sizes=[tuple(size) for size in args.sizes], formats=args.formats)
+    print(f"generated {count} images in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return library
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_run(run):
+    scan = run['scan']
+    print(f"\n{run['images']} images ({run['tagged_images']} tagged): cold scan {scan['cold_list_seconds']:.2f}s "
+          f"+ probe {scan['cold_probe_seconds']:.2f}s, warm scan {scan['warm_seconds']:.3f}s, "
+          f"peak RSS {run['peak_rss_mib']} MiB" + (f", server {run['server_peak_rss_mib']} MiB" if 'server' in run else ''))
+    print(f"{'':<12} {'endpoint':<22} {'req/s':>9} {'first ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for section in ('test_client', 'server'):
+        for name, stats in run.get(section, {}).items():
+            first = stats.get('first_ms')
+            print(f"{section:<12} {name:<22} {stats['requests_per_second'] or 0:>9.1f} {'' if first is None else f'{first:.1f}':>9} "
+                  f"{stats['p50_ms'] or 0:>8.2f} {stats['p95_ms'] or 0:>8.2f} {stats['p99_ms'] or 0:>8.2f} {stats['errors']:>7}")
+
+def flatten(run):
+    # (section, endpoint, stat) -> value for every number worth comparing
+    values = {('run', '', 'peak_rss_mib'): run.get('peak_rss_mib'),
+              ('run', '', 'server_peak_rss_mib'): run.get('server_peak_rss_mib')}
+    values.update((('scan', '', stat), value) for stat, value in run['scan'].items())
+    for section in ('test_client', 'server'):
+        for name, stats in run.get(section, {}).items():
+            values.update(((section, name, stat), value) for stat, value in stats.items())
+    return values
+
+def compare(results, baseline, threshold):
+    # Prints every compared number that moved and returns how many got worse
+    # by more than threshold
+    previous = {run['images']: flatten(run) for run in baseline['runs']}
+    regressions = 0
+    print(f"\ncompared with {baseline.get('commit') or 'an earlier run'} from {baseline.get('created')}")
+    for run in results['runs']:
+        old_values = previous.get(run['images'])
+        if old_values is None:
+            continue
+        for key, value in flatten(run).items():
+            old = old_values.get(key)
+            if key[2] not in COMPARED_STATS or not value or not old:
+                continue
+            change = value / old - 1
+            worse = -change if key[2] in HIGHER_IS_BETTER else change
+            if worse > threshold:
+                regressions += 1
+            if abs(change) > threshold:
+                section, name, stat = key
+                print(f"{'REGRESSION' if worse > threshold else 'improved':<10} {run['images']:>7} {section:<12} {name:<22} "
+                      f"{stat:<20} {old:>10} -> {value:<10} ({change:+.0%})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--formats', nargs='+', choices=sorted(FORMATS), default=['png', 'jpg'])
+    parser.add_argument('--sizes', type=int, nargs=2, action='append', metavar=('WIDTH', 'HEIGHT'),
+                        help="image sizes to pick from, repeatable (default 64x64)")
+    parser.add_argument('--tag-density', type=float, default=3.0, help="tags per image on average")
+    parser.add_argument('--requests', type=int, default=50, help="test client requests per endpoint")
+    parser.add_argument('--server', choices=('auto', 'waitress', 'gunicorn', 'dev', 'none'), default='auto',
+                        help="server to measure after the test client, or none to skip it")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=8, help="connections against the real server")
+    parser.add_argument('--duration', type=float, default=5, help="seconds per endpoint against the real server")
+    parser.add_argument('--corpus-dir', help="keep generated libraries here and reuse them on later runs")
+    parser.add_argument('--output', default='bench_endpoints.json')
+    parser.add_argument('--compare', metavar='JSON', help="an earlier --output to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="relative change counted as a regression")
+    parser.add_argument('--measure', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.sizes = args.sizes or [[64, 64]]
+
+    if args.measure:
+        measure_library(args)
+        return
+
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': {name: value for name, value in vars(args).items() if name not in ('measure', 'compare', 'output')},
+        'runs': []
+    }
+    work_dir = tempfile.mkdtemp(prefix='gallery-bench-')
+    try:
+        corpus_dir = args.corpus_dir or work_dir
+        for count in args.images:
+            library = prepare_corpus(corpus_dir, count, args)
+            run_path = os.path.join(work_dir, f"{count}.json")
+            command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--measure', library, run_path]
+            measured = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            if measured.returncode != 0:
+                sys.exit(f"measuring {count} images failed:\n{measured.stderr}")
+            with open(run_path, encoding='utf-8') as f:
+                run = json.load(f)
+            results['runs'].append(run)
+            print_run(run)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nsaved to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Page weight and time to first byte of the gallery page.
+
+    python benchmarks/bench_page.py --images 10000
+
+Counts the bytes of the HTML and of every stylesheet and script it links to,
+on a first visit and on a repeat visit that has the linked assets cached.
+Timings are warm medians through Flask's test client, so they leave out the
+network and measure the server alone.
+"""
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import statistics
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import waifu_gallery
+from corpus import generate_corpus
+
+def time_first_byte(client, url):
+    # Seconds until the first chunk of the body, and the whole body
+    start = time.perf_counter()
+    response = client.get(url, buffered=False)
+    chunks = iter(response.response)
+    first = next(chunks, b'')
+    elapsed = time.perf_counter() - start
+    body = first + b''.join(chunks)
+    response.close()
+    return elapsed, body
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='gallery-bench-')
+    try:
+        library = os.path.join(work_dir, 'library')
+        generate_corpus(library, args.images, sizes=((64, 64),))
+        waifu_gallery.SETTINGS_DIR = os.path.join(work_dir, 'settings')
+        waifu_gallery.BACKGROUND_JOBS = False
+        waifu_gallery.update_config(lambda config: config.update(image_directory=library))
+        waifu_gallery.probe_pending_images([library])
+        client = waifu_gallery.app.test_client()
+        client.get('/')
+
+        html_times = []
+        for _ in range(args.repeat):
+            elapsed, html = time_first_byte(client, '/')
+            html_times.append(elapsed)
+        assets = re.findall(rb'<(?:link[^>]+href|script[^>]+src)="([^"]+)"', html)
+        asset_bytes = sum(len(client.get(url.decode().replace('&amp;', '&')).data) for url in assets)
+
+        # A page without images in its HTML fetches its first page of them
+        # from the API, so that request is part of what a visit costs
+        data_url = None if b'data-id=' in html else f'/get_images?stream=1&limit={waifu_gallery.PAGE_SIZE}'
+        data_times = []
+        data = b''
+        if data_url is not None:
+            for _ in range(args.repeat):
+                elapsed, data = time_first_byte(client, data_url)
+                data_times.append(elapsed)
+
+        print(f"{args.images} images, {len(assets)} linked assets")
+        print(f"HTML:                  {len(html) / 1024:>8.1f} KiB, first byte {statistics.median(html_times) * 1000:.1f} ms")
+        if data_url is not None:
+            print(f"first page of images:  {len(data) / 1024:>8.1f} KiB, first byte {statistics.median(data_times) * 1000:.1f} ms")
+        print(f"assets:                {asset_bytes / 1024:>8.1f} KiB")
+        print(f"first visit:           {(len(html) + len(data) + asset_bytes) / 1024:>8.1f} KiB")
+        print(f"repeat visit:          {(len(html) + len(data)) / 1024:>8.1f} KiB")
+    finally:
+        waifu_gallery.flush_config()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
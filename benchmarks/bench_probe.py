@@ -0,0 +1,76 @@
+"""Probes per second of the header readers against opening every file with Pillow.
+
+    python benchmarks/bench_probe.py --count 2000 --formats png jpg gif bmp
+
+Both run serially over the same files, which are read once beforehand so the
+numbers compare parsing rather than the disk.
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import waifu_gallery
+from PIL import Image
+from corpus import FORMATS, generate_corpus
+
+PROBE_FIELDS = ('width', 'height', 'format', 'mode', 'frames')
+
+def probe_with_pillow(file_path):
+    # probe_image as it was before the header readers: Pillow for every file
+    try:
+        with Image.open(file_path) as img:
+            return {
+                'width': img.width,
+                'height': img.height,
+                'format': img.format,
+                'mode': img.mode,
+                'frames': getattr(img, 'n_frames', 1)
+            }
+    except Exception:
+        return {'width': None, 'height': None, 'format': None, 'mode': None, 'frames': None}
+
+def measure(probe, paths, repeat):
+    # Best of repeat runs, in probes per second
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            probe(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(paths) / best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--formats', nargs='+', choices=sorted(FORMATS), default=['png', 'jpg', 'gif', 'bmp'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='gallery-bench-')
+    try:
+        print(f"{'format':>8} {'files':>6} {'pillow/s':>10} {'header/s':>10} {'speedup':>8} {'fallbacks':>10}")
+        for extension in args.formats:
+            image_dir = os.path.join(work_dir, extension)
+            paths = [os.path.join(image_dir, filename) for filename in generate_corpus(image_dir, args.count, formats=(extension,))]
+            for path in paths:
+                with open(path, 'rb') as f:
+                    f.read()
+            for path in paths:
+                expected = probe_with_pillow(path)
+                actual = waifu_gallery.probe_image(path)
+                assert all(actual[field] == expected[field] for field in PROBE_FIELDS), (path, expected, actual)
+            fallbacks = sum(1 for path in paths if waifu_gallery.read_image_header(path) is None)
+            pillow = measure(probe_with_pillow, paths, args.repeat)
+            header = measure(waifu_gallery.probe_image, paths, args.repeat)
+            print(f"{extension:>8} {len(paths):>6} {pillow:>10.0f} {header:>10.0f} {header / pillow:>7.1f}x {fallbacks:>10}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
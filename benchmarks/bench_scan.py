@@ -0,0 +1,58 @@
+"""Cold and warm scan throughput of get_images_from_directory and the probe job.
+
+    python benchmarks/bench_scan.py --count 10000 --workers 1 4 8 16
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import waifu_gallery
+from corpus import generate_corpus
+
+def run_scan(image_dir, settings_dir, workers):
+    # The scan only lists files and queues new ones for the probe job, so the
+    # listing and the probing are timed separately here; hashing is left out
+    waifu_gallery.BACKGROUND_JOBS = False
+    waifu_gallery.SETTINGS_DIR = settings_dir
+    waifu_gallery.index_ready = False
+    start = time.perf_counter()
+    images, all_tags = waifu_gallery.get_images_from_directory(image_dir, {})
+    listing = time.perf_counter() - start
+    start = time.perf_counter()
+    while waifu_gallery.probe_pending_images([image_dir], workers):
+        pass
+    return len(images), listing, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--image-dir', help="reuse an existing directory instead of generating one")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='gallery-bench-')
+    try:
+        image_dir = args.image_dir
+        if image_dir is None:
+            image_dir = os.path.join(work_dir, 'images')
+            start = time.perf_counter()
+            generate_corpus(image_dir, args.count)
+            print(f"generated {args.count} images in {time.perf_counter() - start:.1f}s")
+
+        print(f"{'workers':>8} {'images':>8} {'list s':>8} {'probe s':>8} {'probe img/s':>12} {'warm s':>8}")
+        for workers in args.workers:
+            settings_dir = os.path.join(work_dir, f'settings-{workers}')
+            os.makedirs(settings_dir)
+            count, listing, probing = run_scan(image_dir, settings_dir, workers)
+            count, warm, _ = run_scan(image_dir, settings_dir, workers)
+            print(f"{workers:>8} {count:>8} {listing:>8.2f} {probing:>8.2f} {count / probing:>12.0f} {warm:>8.2f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
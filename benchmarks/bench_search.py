@@ -0,0 +1,79 @@
+"""Full-text search index build time and query latency.
+
+    python benchmarks/bench_search.py --rows 100000
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import waifu_gallery
+
+WORDS = [f"word{i}" for i in range(5000)]
+SOURCES = ['pixiv', 'twitter', 'danbooru', 'artstation', 'deviantart', 'tumblr']
+TAGS = [f"tag{i}" for i in range(300)]
+
+def make_image_info(rows, rng):
+    image_info = {}
+    for i in range(rows):
+        image_info[f"image_{i:07d}.png"] = {
+            'info': ' '.join(rng.choices(WORDS, k=rng.randint(3, 30))),
+            'source': f"https://{rng.choice(SOURCES)}.example/{i}",
+            'tags': ', '.join(rng.sample(TAGS, 5))
+        }
+    return image_info
+
+def fill_images_table(directory, filenames):
+    conn = waifu_gallery.open_index()
+    try:
+        conn.executemany('''
+            INSERT INTO images (directory, filename, folder, size, mtime_ns, inode, width, height, format, mode, frames)
+            VALUES (?, ?, '', 1000, 0, ?, 640, 480, 'PNG', 'RGB', 1)
+        ''', [(directory, filename, i) for i, filename in enumerate(filenames)])
+        conn.commit()
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=100, help="page size requested per query")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    settings_dir = tempfile.mkdtemp(prefix='gallery-bench-')
+    try:
+        waifu_gallery.SETTINGS_DIR = settings_dir
+        waifu_gallery.index_ready = False
+        directory = '/synthetic'
+        roots = [directory]
+        image_info = make_image_info(args.rows, rng)
+        fill_images_table(directory, sorted(image_info))
+
+        start = time.perf_counter()
+        waifu_gallery.sync_search_index(roots, image_info)
+        print(f"index build: {args.rows} rows in {time.perf_counter() - start:.2f}s")
+
+        queries = ['word1', 'word42 word43', 'wor', 'pixiv', 'image_00012', 'tag7', 'word4999 pixiv']
+        print(f"{'query':<20} {'tags':<8} {'hits':>8} {'median ms':>10} {'max ms':>8}")
+        for query in queries:
+            for tag_filters in (((), (), ()), (('tag1',), (), ())):
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    rows, total = waifu_gallery.search_images(roots, image_info, query, 0, args.limit, tag_filters)
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                tags = ','.join(tag_filters[0]) or '-'
+                print(f"{query:<20} {tags:<8} {total:>8} {timings[len(timings) // 2]:>10.2f} {timings[-1]:>8.2f}")
+    finally:
+        shutil.rmtree(settings_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
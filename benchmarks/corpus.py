@@ -0,0 +1,42 @@
+import os
+import random
+from PIL import Image
+
+FORMATS = {
+    'png': 'PNG',
+    'jpg': 'JPEG',
+    'gif': 'GIF',
+    'bmp': 'BMP'
+}
+
+def generate_corpus(directory, count, sizes=((64, 64), (320, 240), (1024, 768)), formats=('png', 'jpg'), seed=0):
+    # Writes count small synthetic images into directory and returns their
+    # filenames. Images are solid colours so generation stays fast, but each
+    # file still carries a real header in the requested format and size.
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    filenames = []
+    for i in range(count):
+        extension = formats[i % len(formats)]
+        width, height = rng.choice(sizes)
+        filename = f"synthetic_{i:07d}.{extension}"
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        Image.new('RGB', (width, height), color).save(os.path.join(directory, filename), FORMATS[extension])
+        filenames.append(filename)
+    return filenames
+
+def generate_image_info(filenames, tag_density=3.0, tag_count=300, seed=0):
+    # image_info for filenames with tag_density tags per image on average.
+    # Tags are drawn with falling weights, so a few are on many images and
+    # most on few, as in a hand-tagged library. Images that get no tags are
+    # left out, since config.json only holds images someone has edited.
+    rng = random.Random(seed)
+    tags = [f"tag{i}" for i in range(tag_count)]
+    weights = [1 / (i + 1) for i in range(tag_count)]
+    most = min(tag_count, round(2 * tag_density))
+    image_info = {}
+    for filename in filenames:
+        chosen = set(rng.choices(tags, weights, k=rng.randint(0, most)))
+        if chosen:
+            image_info[filename] = {'info': '', 'source': '', 'tags': ', '.join(sorted(chosen))}
+    return image_info
@@ -0,0 +1,80 @@
+"""Requests/sec against a running gallery server.
+
+    python waifu_gallery.py --settings-dir /path/to/settings --workers 4 &
+    python benchmarks/load_test.py --url http://127.0.0.1:5005 --concurrency 16 --duration 10
+"""
+import sys
+import time
+import json
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit, quote
+
+def fetch_json(base, path):
+    parts = urlsplit(base)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+    try:
+        conn.request('GET', path)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+def hammer(base, path, deadline, latencies, errors):
+    parts = urlsplit(base)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 400:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(repr(e))
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+def run(base, path, concurrency, duration):
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=hammer, args=(base, path, deadline, latencies, errors))
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else float('nan')
+
+    print(f"{path[:40]:<40} {len(latencies) / elapsed:>9.1f} {percentile(0.5):>8.1f} {percentile(0.95):>8.1f} {percentile(0.99):>8.1f} {len(errors):>7}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5005')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--page-size', type=int, default=100, help="limit used for paginated /get_images")
+    args = parser.parse_args()
+
+    first = fetch_json(args.url, '/get_images?limit=1')
+    if not first['images']:
+        sys.exit("The gallery has no images; point it at a directory first")
+    filename = quote(first['images'][0]['original'])
+
+    print(f"{'path':<40} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for path in ('/get_images', f'/get_images?limit={args.page_size}', f'/images/{filename}'):
+        run(args.url, path, args.concurrency, args.duration)
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,292 @@
+import io
 import os
+import re
+import sys
+import csv
+import math
+import struct
+import posixpath
 import json
 import time
-from flask import Flask, render_template_string, send_from_directory, request, redirect, url_for, jsonify
-from werkzeug.utils import secure_filename
-from PIL import Image
+import sqlite3
+import hashlib
+import tempfile
+import queue
+import heapq
+import inspect
+import atexit
+import bisect
+import cProfile
+import pstats
+import argparse
+import threading
+import importlib.util
+from contextlib import contextmanager
+from itertools import count
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, has_request_context, render_template, send_file, request, redirect, url_for, jsonify
+from flask import before_render_template, template_rendered
+from werkzeug.security import safe_join
+from jinja2 import DictLoader
+from PIL import Image, ImageOps, features
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    # Without watchdog the library watcher falls back to rescanning on a timer
+    Observer = None
+
+try:
+    import numpy
+except ImportError:
+    # Perceptual hashes then use a pure-Python DCT, which is slower but equal
+    numpy = None
+
+try:
+    import pyinstrument
+except ImportError:
+    # ?profile=pyinstrument then gets the cProfile report like ?profile does
+    pyinstrument = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 app = Flask(__name__)
 
 # User should set this to the desired settings directory
 SETTINGS_DIR = r""
 
-# Global variable to store the last modified time of the image directory
-last_modified_time = 0
+# The settings directory can also come from the environment, which is handy
+# when the app is started by an external WSGI server
+SETTINGS_DIR = os.environ.get('GALLERY_SETTINGS_DIR', SETTINGS_DIR)
+
+# Bump this whenever the layout of the images table changes; the index is only a
+# cache of what is on disk, so an outdated one is simply dropped and rebuilt.
+INDEX_SCHEMA_VERSION = 8
+
+index_lock = threading.Lock()
+index_ready = False
+
+# Number of threads used to probe image headers during a scan. Can be overridden
+# per library with "scan_workers" in config.json; 1 probes serially.
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+# A folder whose mtime is this close to the moment it was listed gets listed
+# again on the next scan: on a filesystem with a coarse clock, a file could
+# have been added within the same tick without moving the folder's mtime.
+RACY_MTIME_WINDOW = 2.0
+
+# Folders in which the watcher saw a file event since the last scan. Those are
+# listed even when their mtime is unchanged, which is the case for files that
+# were rewritten in place.
+dirty_folders = set()
+dirty_folders_lock = threading.Lock()
+
+# Number of images rendered with the initial page and fetched per scroll step
+PAGE_SIZE = 100
+
+# Every sort key ends with the filename so that ties always break the same way
+# and offsets stay stable between page requests.
+SORT_KEYS = {
+    'name': lambda image: (image.original.lower(), image.original),
+    'mtime': lambda image: (image.mtime_ns / 1e9, image.original),
+    'dimensions': lambda image: ((image.width or 0) * (image.height or 0), image.original)
+}
+
+# The same orderings in SQL, for pages streamed straight from an index cursor.
+# id is the image ID and lower() is Python's, registered on the connection.
+SQL_SORT_KEYS = {
+    'name': ('py_lower(id)', 'id'),
+    'mtime': ('mtime_ns / 1e9', 'id'),
+    'dimensions': ('coalesce(width, 0) * coalesce(height, 0)', 'id')
+}
+
+# Thumbnails are rendered at twice the 200px grid cell so they stay sharp on
+# high-DPI screens, and kept under SETTINGS_DIR/thumbs up to the size cap below.
+THUMBNAIL_SIZE = (400, 400)
+THUMBNAIL_CACHE_LIMIT = 512 * 1024 * 1024
+THUMBNAIL_MAX_AGE = 3600
+THUMBNAIL_FORMAT = 'WEBP' if features.check('webp') else 'JPEG'
+
+# The modal viewer shows the thumbnail at once and then a rendition scaled to
+# fit SCREEN_SIZE, which shares the thumbnail cache; originals that already fit
+# are sent as they are. It loads the VIEWER_PREFETCH images on either side of
+# the one on screen ahead of time.
+SCREEN_SIZE = (2560, 2560)
+VIEWER_PREFETCH = int(os.environ.get('GALLERY_PREFETCH', 2))
+
+# Images and thumbnails requested with ?v=<version> matching the file's current
+# version can be cached for this long without revalidation, since any change
+# to the file produces a different URL.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+thumbnail_lock = threading.Lock()
+thumbnail_cache_size = None
+
+# The library watcher rescans after a filesystem event (or every
+# WATCH_POLL_INTERVAL seconds when watchdog is not installed) and pushes the
+# differences to every /events subscriber.
+WATCH_POLL_INTERVAL = 5
+WATCH_IDLE_INTERVAL = 60
+WATCH_DEBOUNCE = 0.5
+# Files rewritten in place leave their folder's mtime alone, so without a
+# watchdog event pointing at the folder they are only picked up by a full
+# rescan. update_index does one per root this often, whether or not the
+# watcher is running; the time of the last one is kept in the index.
+FULL_RESCAN_INTERVAL = 3600
+EVENT_QUEUE_SIZE = 100
+EVENT_KEEPALIVE = 15
+# An open /events stream holds one request thread for as long as its tab is
+# open, so serve() keeps them to half of the threads and ordinary requests
+# always find a thread free. Tabs turned away poll /check_updates instead
+# every EVENT_POLL_INTERVAL seconds. None leaves them uncapped, which suits
+# Flask's server with its thread per connection.
+EVENT_STREAM_LIMIT = int(os.environ['GALLERY_EVENT_STREAMS']) if os.environ.get('GALLERY_EVENT_STREAMS') else None
+EVENT_POLL_INTERVAL = 5
+
+library_changed = threading.Event()
+watcher_lock = threading.Lock()
+watcher_thread = None
+subscribers = []
+subscribers_lock = threading.Lock()
+
+# config.json is parsed once and kept in memory until its mtime or size
+# changes. Edits are applied to the cached copy straight away and written out
+# together once no further edit has arrived for CONFIG_WRITE_DELAY seconds.
+CONFIG_WRITE_DELAY = 0.5
+
+config_lock = threading.RLock()
+config_cache = None
+config_signature = None
+config_pending = []
+config_flush_timer = None
+# Updated and read with config_lock held
+config_stats = {'reads': 0, 'reloads': 0, 'read_seconds': 0.0, 'writes': 0}
+
+# Fields of an image_info entry as /export_image_info writes them and
+# /import_image_info reads them, and what an edit sent to /bulk_edit may set.
+# Exports are sent EXPORT_CHUNK entries at a time.
+IMAGE_INFO_FIELDS = ('image_id', 'info', 'source', 'tags')
+IMAGE_EDIT_FIELDS = ('info', 'source', 'tags', 'add_tags', 'remove_tags')
+EXPORT_CHUNK = 1000
+
+# Inverted index from tag to image IDs, built from the image_info dict it was
+# last handed and kept current by set_image_tags. A reloaded config brings a
+# new image_info dict, which triggers a rebuild on next use.
+tag_index_lock = threading.Lock()
+tag_index_source = None
+tags_by_image = {}
+images_by_tag = {}
+
+# Image IDs seen by the most recent scan, used as the universe for tag queries,
+# along with the roots it covered and the newest folder mtime it found
+last_scan = {'roots': None, 'images': frozenset(), 'modified_time': None}
+
+# Full-text search weights for the filename, info, source and tags columns
+SEARCH_WEIGHTS = (4.0, 1.0, 1.0, 2.0)
+
+# (roots, image_info) the image_text table was last reconciled against
+search_index_source = (None, None)
+
+# Perceptual hashes are 64-bit and computed in the background for every image
+# in the index. Near-duplicates are images whose hashes differ in at most
+# DUPLICATE_DISTANCE bits; pHash survives resizing and re-encoding best.
+HASH_KINDS = ('phash', 'dhash', 'ahash')
+HASH_BATCH = 256
+DUPLICATE_DISTANCE = 6
+MAX_DUPLICATE_DISTANCE = 11
+
+# Grouping runs as a job that gives way every DUPLICATE_BATCH hashes. A
+# request waits DUPLICATE_WAIT seconds for it and otherwise answers that the
+# search is pending. The clusters of the last DUPLICATE_SEARCHES searches are
+# kept, keyed by (roots, kind, distance) and all from the hashes as they were
+# at one hash_generation; a newer generation drops them.
+DUPLICATE_BATCH = 4096
+DUPLICATE_WAIT = 1
+DUPLICATE_SEARCHES = 16
+duplicates_cache = {'generation': None, 'searches': OrderedDict()}
+duplicates_lock = threading.Lock()
+
+# Reading image headers, hashing and rendering thumbnails run as jobs on a
+# small pool of worker threads rather than in the request that needed them.
+# Lower priority numbers run first, and an identical job that is still
+# waiting in the queue or already running absorbs a new submission instead of
+# running twice. Long jobs are generators that yield between batches, which
+# lets a worker put them back in the queue when something more urgent is
+# waiting. At exit, workers get JOB_STOP_TIMEOUT seconds to reach the end of
+# the step they are in.
+JOB_WORKERS = 2
+JOB_STOP_TIMEOUT = 5
+JOB_HISTORY = 100
+JOB_PRIORITY_HIGH = 0
+JOB_PRIORITY_NORMAL = 10
+JOB_PRIORITY_LOW = 20
+PROBE_BATCH = 256
+THUMBNAIL_WAIT = 10
+
+# Set to False to leave probing and hashing to the caller, as the benchmarks do
+BACKGROUND_JOBS = True
+
+# Request latencies, time spent per phase of scanning and rendering, and cache
+# and probe counters, served in Prometheus' text format on /metrics. Every
+# process counts for itself, so with several gunicorn workers each scrape
+# sees the worker that answered it. With PROFILE_REQUESTS set, adding
+# ?profile to any URL returns a profile of that request instead of its response.
+METRICS_ENABLED = os.environ.get('GALLERY_METRICS', '1') != '0'
+PROFILE_REQUESTS = os.environ.get('GALLERY_PROFILE', '0') == '1'
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_LINES = 60
+
+# Phases timed by time_phase(), with the description used in Server-Timing
+TIMED_PHASES = {
+    'config': "config read",
+    'list': "folder listing",
+    'index': "index write",
+    'catalog': "catalog build",
+    'probe': "header probing",
+    'hash': "perceptual hashing",
+    'thumbnail': "thumbnail render",
+    'screen': "screen rendition render",
+    'search': "search query",
+    'duplicates': "duplicate search",
+    'render': "template render"
+}
+
+METRICS = {
+    'gallery_request_duration_seconds': ('histogram', "Time until a handler returned its response, by route"),
+    'gallery_phase_duration_seconds': ('histogram', "Time spent in each phase of scanning, indexing and rendering"),
+    'gallery_cache_requests_total': ('counter', "Cache lookups by cache and result"),
+    'gallery_files_probed_total': ('counter', "Image headers read by the probe job, by result"),
+    'gallery_files_hashed_total': ('counter', "Images hashed by the hash job, by result"),
+    'gallery_config_reads_total': ('counter', "load_config() calls"),
+    'gallery_config_reloads_total': ('counter', "Times config.json was parsed"),
+    'gallery_config_read_seconds_total': ('counter', "Time spent in load_config()"),
+    'gallery_config_writes_total': ('counter', "Times config.json was written"),
+    'gallery_jobs_queued': ('gauge', "Jobs waiting for a worker"),
+    'gallery_event_streams_refused_total': ('counter', "/events requests turned away because every stream slot was taken")
+}
+
+metrics_lock = threading.Lock()
+# (name, labels) -> a number for counters, or per-bucket counts followed by
+# the +Inf count and the sum for histograms
+metric_values = {}
+profile_lock = threading.Lock()
+
+job_condition = threading.Condition()
+job_queue = []
+job_sequence = count(1)
+jobs = {}
+queued_jobs = {}
+running_jobs = {}
+finished_jobs = deque()
+job_threads = []
+jobs_stopping = False
 
 def ensure_config_file():
     if SETTINGS_DIR is None:
@@ -24,23 +299,193 @@ def ensure_config_file():
     if not os.path.exists(config_path):
         default_config = {
             "image_directory": "",
-            "image_info": {}
+            "extra_directories": [],
+            "image_info": {},
+            "image_id_version": IMAGE_ID_VERSION
         }
-        with open(config_path, 'w') as f:
-            json.dump(default_config, f, indent=4)
+        save_config(default_config)
     return True
 
+def get_config_signature():
+    st = os.stat(os.path.join(SETTINGS_DIR, 'config.json'))
+    return (st.st_mtime_ns, st.st_size)
+
+def read_config_file():
+    # Must be called with config_lock held. Edits that are still waiting to be
+    # written are replayed on top, so a file rewritten underneath us (by hand
+    # or by another process) does not make them disappear.
+    global config_cache, config_signature
+    with open(os.path.join(SETTINGS_DIR, 'config.json'), 'r') as f:
+        config_cache = json.load(f)
+    config_signature = get_config_signature()
+    for mutator in config_pending:
+        mutator(config_cache)
+    if config_cache.get('image_id_version', 1) < IMAGE_ID_VERSION:
+        migrate_image_ids(config_cache)
+        queue_config_edit(migrate_image_ids)
+    config_stats['reloads'] += 1
+
 def load_config():
-    if not ensure_config_file():
+    if SETTINGS_DIR is None:
         return None
-    config_path = os.path.join(SETTINGS_DIR, 'config.json')
-    with open(config_path, 'r') as f:
-        return json.load(f)
+    start = time.perf_counter()
+    with config_lock:
+        try:
+            signature = get_config_signature()
+        except OSError:
+            if not ensure_config_file():
+                return None
+            signature = get_config_signature()
+        if config_cache is None or signature != config_signature:
+            read_config_file()
+        config = config_cache
+        elapsed = time.perf_counter() - start
+        config_stats['reads'] += 1
+        config_stats['read_seconds'] += elapsed
+    record_phase('config', elapsed)
+    return config
 
 def save_config(config):
+    # Write to a temporary file in the same directory and rename it over
+    # config.json, so readers only ever see the old or the new file in full.
     config_path = os.path.join(SETTINGS_DIR, 'config.json')
-    with open(config_path, 'w') as f:
-        json.dump(config, f, indent=4)
+    fd, temp_path = tempfile.mkstemp(dir=SETTINGS_DIR, prefix='config.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(config, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, config_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    with config_lock:
+        config_stats['writes'] += 1
+
+@contextmanager
+def config_file_lock():
+    # Serializes config.json writes between worker processes
+    with open(os.path.join(SETTINGS_DIR, 'config.lock'), 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def queue_config_edit(mutator):
+    # Must be called with config_lock held, once mutator has been applied to
+    # the cached config
+    global config_flush_timer
+    config_pending.append(mutator)
+    if config_flush_timer is None:
+        config_flush_timer = threading.Timer(CONFIG_WRITE_DELAY, flush_config)
+        config_flush_timer.daemon = True
+        config_flush_timer.start()
+
+def update_config(mutator):
+    # Applies mutator(config) to the cached config now and schedules a write.
+    with config_lock:
+        config = load_config()
+        if config is None:
+            return None
+        mutator(config)
+        queue_config_edit(mutator)
+        return config
+
+def flush_config():
+    global config_flush_timer, config_signature
+    with config_lock:
+        if config_flush_timer is not None:
+            config_flush_timer.cancel()
+            config_flush_timer = None
+        if not config_pending:
+            return
+        with config_file_lock():
+            try:
+                if get_config_signature() != config_signature:
+                    read_config_file()
+            except OSError:
+                pass
+            save_config(config_cache)
+            config_signature = get_config_signature()
+        config_pending.clear()
+
+atexit.register(flush_config)
+
+def count_metric(name, amount=1, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metric_values[key] = metric_values.get(key, 0) + amount
+
+def observe_metric(name, value, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = metric_values.get(key)
+        if histogram is None:
+            histogram = metric_values[key] = [0] * (len(METRIC_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+        histogram[-1] += value
+
+def record_phase(phase, elapsed):
+    observe_metric('gallery_phase_duration_seconds', elapsed, phase=phase)
+    if has_request_context():
+        phases = g.setdefault('phase_seconds', {})
+        phases[phase] = phases.get(phase, 0.0) + elapsed
+
+@contextmanager
+def time_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+def render_metrics():
+    with metrics_lock:
+        values = {key: list(value) if isinstance(value, list) else value for key, value in metric_values.items()}
+    # Numbers kept elsewhere are read at scrape time
+    with config_lock:
+        values[('gallery_config_reads_total', ())] = config_stats['reads']
+        values[('gallery_config_reloads_total', ())] = config_stats['reloads']
+        values[('gallery_config_read_seconds_total', ())] = config_stats['read_seconds']
+        values[('gallery_config_writes_total', ())] = config_stats['writes']
+    with job_condition:
+        values[('gallery_jobs_queued', ())] = len(job_queue)
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (metric, labels), value in sorted(values.items()):
+            if metric != name:
+                continue
+            if kind != 'histogram':
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, bucket in zip(METRIC_BUCKETS + ('+Inf',), value):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
 
 def shorten_filename(filename, max_length=20):
     name, ext = os.path.splitext(filename)
@@ -48,435 +493,2916 @@ def shorten_filename(filename, max_length=20):
         return name[:max_length-3] + '...' + ext
     return filename
 
-def get_image_dimensions(file_path):
+# Header probing. The size, mode and frame count of the common PNG, JPEG, GIF
+# and BMP variants are read straight from the bytes before the pixel data,
+# along with the EXIF orientation and capture date, which is several times
+# faster than having Pillow identify the file. Anything the readers below do
+# not fully understand is left to Pillow, so both paths store the same values.
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# (bit depth, colour type) -> the mode Pillow opens the PNG in
+PNG_MODES = {
+    (1, 0): '1', (2, 0): 'L', (4, 0): 'L', (8, 0): 'L', (16, 0): 'I;16',
+    (8, 2): 'RGB', (16, 2): 'RGB',
+    (1, 3): 'P', (2, 3): 'P', (4, 3): 'P', (8, 3): 'P',
+    (8, 4): 'LA', (16, 4): 'RGBA',
+    (8, 6): 'RGBA', (16, 6): 'RGBA'
+}
+# Start-of-frame markers; C4, C8 and CC fall in the same range but are not frames
+JPEG_FRAME_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+# Pillow opens a GIF whose palette maps every index to the same grey as 'L'
+GRAYSCALE_PALETTE = bytes(i // 3 for i in range(768))
+BMP_HEADER_SIZES = (40, 52, 56, 64, 108, 124)
+
+# EXIF orientations that turn the image by a quarter, so it is shown with
+# width and height swapped, as the thumbnails and the viewer do
+ROTATED_ORIENTATIONS = frozenset((5, 6, 7, 8))
+EXIF_DATE = re.compile(r'(\d{4}):(\d{2}):(\d{2}) (\d{2}):(\d{2}):(\d{2})')
+
+def read_tiff_ifd(data, byte_order, offset):
+    # Tag -> (type, count, raw value field) for one directory of a TIFF block
+    count = struct.unpack_from(byte_order + 'H', data, offset)[0]
+    return {tag: (kind, length, value) for tag, kind, length, value in
+            (struct.unpack_from(byte_order + 'HHI4s', data, offset + 2 + 12 * index) for index in range(count))}
+
+def read_exif(data):
+    # Orientation (1-8) and capture date ("YYYY-MM-DD HH:MM:SS") from an EXIF
+    # block, each None when missing or unreadable. The date is the time the
+    # picture was taken if the camera recorded it, else when it was last saved.
+    orientation = taken_at = None
+    if data is None:
+        return orientation, taken_at
+    if data.startswith(b'Exif\0\0'):
+        data = data[6:]
+    byte_order = {b'II': '<', b'MM': '>'}.get(data[:2])
+    if byte_order is None:
+        return orientation, taken_at
+    try:
+        ifd = read_tiff_ifd(data, byte_order, struct.unpack_from(byte_order + 'I', data, 4)[0])
+        kind, length, value = ifd.get(0x0112, (None, 0, b''))
+        if kind == 3 and 1 <= struct.unpack_from(byte_order + 'H', value)[0] <= 8:
+            orientation = struct.unpack_from(byte_order + 'H', value)[0]
+        dates = [ifd.get(0x0132)]
+        if 0x8769 in ifd:
+            exif_ifd = read_tiff_ifd(data, byte_order, struct.unpack_from(byte_order + 'I', ifd[0x8769][2])[0])
+            dates.insert(0, exif_ifd.get(0x9003))
+        for date in dates:
+            if date is None or date[0] != 2 or date[1] < 19:
+                continue
+            start = struct.unpack_from(byte_order + 'I', date[2])[0]
+            match = EXIF_DATE.match(data[start:start + date[1]].decode('ascii', 'replace'))
+            if match is not None and match.group(1) != '0000':
+                taken_at = '{}-{}-{} {}:{}:{}'.format(*match.groups())
+                break
+    except struct.error:
+        pass
+    return orientation, taken_at
+
+def make_probe(width, height, image_format, mode, frames=1, exif=None):
+    # Pillow refuses empty images and warns about or refuses huge ones, so
+    # those go to it to decide
+    if width <= 0 or height <= 0 or (Image.MAX_IMAGE_PIXELS and width * height > Image.MAX_IMAGE_PIXELS):
+        return None
+    orientation, taken_at = read_exif(exif)
+    return {'width': width, 'height': height, 'format': image_format, 'mode': mode, 'frames': frames,
+            'orientation': orientation, 'taken_at': taken_at}
+
+def read_png_header(f, head):
+    # IHDR comes first, and the chunks between it and the image data may carry
+    # the frame count of an APNG (acTL) and an EXIF block (eXIf)
+    if head[8:16] != b'\0\0\0\rIHDR' or head[27] != 0:
+        return None
+    width, height = struct.unpack_from('>II', head, 16)
+    mode = PNG_MODES.get((head[24], head[25]))
+    if mode is None:
+        return None
+    frames = 1
+    exif = None
+    f.seek(33)
+    while True:
+        length, kind = struct.unpack('>I4s', f.read(8))
+        if kind in (b'IDAT', b'IEND'):
+            break
+        if kind == b'acTL' and length >= 8:
+            count = struct.unpack('>I', f.read(4))[0]
+            frames = count if 0 < count <= 0x80000000 else 1
+            f.seek(length, 1)
+        elif kind == b'eXIf' and exif is None:
+            exif = f.read(length)
+            f.seek(4, 1)
+        else:
+            f.seek(length + 4, 1)
+    return make_probe(width, height, 'PNG', mode, frames, exif)
+
+def read_jpeg_header(f):
+    # Walks the marker segments up to the start of the scan, like Pillow does
+    # before it accepts the file, picking up the frame header and the first
+    # EXIF block on the way. Multi-picture files are left to Pillow, which
+    # opens them as MPO.
+    frame = exif = None
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+        code = marker[1]
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        if code == 0xDA:
+            break
+        if code in (0xD8, 0xD9):
+            return None
+        length = struct.unpack('>H', f.read(2))[0] - 2
+        if length < 0:
+            return None
+        if code in JPEG_FRAME_MARKERS and frame is None:
+            frame = struct.unpack('>BHHB', f.read(6))
+            f.seek(length - 6, 1)
+        elif code == 0xE1 and exif is None:
+            data = f.read(length)
+            if data.startswith(b'Exif\0\0'):
+                exif = data
+        elif code == 0xE2:
+            if f.read(length).startswith(b'MPF\0'):
+                return None
+        else:
+            f.seek(length, 1)
+    if frame is None:
+        return None
+    precision, height, width, layers = frame
+    if precision != 8 or layers not in JPEG_MODES:
+        return None
+    return make_probe(width, height, 'JPEG', JPEG_MODES[layers], 1, exif)
+
+def skip_gif_blocks(f):
+    while True:
+        size = f.read(1)
+        if not size:
+            raise EOFError("truncated GIF")
+        if size[0] == 0:
+            return
+        f.seek(size[0], 1)
+
+def read_gif_header(f, head):
+    # Counts the frames by stepping over the data blocks without decoding
+    # them. The mode and size follow the first frame the way Pillow sets them.
+    width, height = struct.unpack_from('<HH', head, 6)
+    flags = head[10]
+    f.seek(13)
+    palette = f.read(3 << ((flags & 7) + 1)) if flags & 0x80 else b''
+    has_palette = palette != GRAYSCALE_PALETTE[:len(palette)]
+    frames = 0
+    while True:
+        block = f.read(1)
+        if not block or block == b';':
+            break
+        if block == b'!':
+            f.read(1)
+            skip_gif_blocks(f)
+        elif block == b',':
+            left, top, frame_width, frame_height, flags = struct.unpack('<HHHHB', f.read(9))
+            local_palette = f.read(3 << ((flags & 7) + 1)) if flags & 0x80 else None
+            if frames == 0:
+                width, height = max(width, left + frame_width), max(height, top + frame_height)
+                if local_palette is not None:
+                    has_palette = local_palette != GRAYSCALE_PALETTE[:len(local_palette)]
+            f.read(1)
+            skip_gif_blocks(f)
+            frames += 1
+    if frames == 0:
+        return None
+    return make_probe(width, height, 'GIF', 'P' if has_palette else 'L', frames)
+
+def read_bmp_header(f, head):
+    # Only uncompressed 16, 24 and 32 bit pixels; palette images have their
+    # mode decided by the palette contents, which is left to Pillow
+    header_size = struct.unpack_from('<I', head, 14)[0]
+    if header_size not in BMP_HEADER_SIZES:
+        return None
+    f.seek(14)
+    header = f.read(header_size)
+    if len(header) < header_size:
+        return None
+    width, height, planes, bits, compression = struct.unpack_from('<IIHHI', header, 4)
+    if header[11] == 0xFF:
+        # A negative height marks rows stored top to bottom
+        height = 2**32 - height
+    if bits not in (16, 24, 32) or compression != 0:
+        return None
+    return make_probe(width, height, 'BMP', 'RGB')
+
+def read_image_header(file_path):
+    # The probe of a file one of the readers above fully understands, or None
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(64)
+            if head.startswith(PNG_SIGNATURE):
+                return read_png_header(f, head)
+            if head.startswith(b'\xff\xd8'):
+                return read_jpeg_header(f)
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return read_gif_header(f, head)
+            if head.startswith(b'BM'):
+                return read_bmp_header(f, head)
+    except (OSError, EOFError, IndexError, struct.error):
+        return None
+    return None
+
+def probe_image(file_path):
+    # Everything else is opened with Pillow, without decoding the pixels.
+    # Pillow raises many kinds of errors for corrupt files; any of them makes
+    # the probe fail, and probe_pending_images() stores that as a negative
+    # entry so the file is not read again until it changes.
+    probe = read_image_header(file_path)
+    if probe is not None:
+        return probe
     try:
         with Image.open(file_path) as img:
-            return f"{img.width}x{img.height}"
-    except:
+            orientation, taken_at = read_exif(img.info.get('exif'))
+            return {
+                'width': img.width,
+                'height': img.height,
+                'format': img.format,
+                'mode': img.mode,
+                'frames': getattr(img, 'n_frames', 1),
+                'orientation': orientation,
+                'taken_at': taken_at
+            }
+    except Exception:
+        return {'width': None, 'height': None, 'format': None, 'mode': None, 'frames': None,
+                'orientation': None, 'taken_at': None}
+
+def format_dimensions(width, height):
+    if width is None or height is None:
         return "Unknown"
+    return f"{width}x{height}"
 
-def get_images_from_directory(directory_path, image_info):
+def get_image_dimensions(file_path):
+    probe = probe_image(file_path)
+    return format_dimensions(probe['width'], probe['height'])
+
+# Low-frequency half of a 32-point DCT-II basis, enough for the 8x8 block
+# that pHash keeps
+DCT_BASIS = [[math.cos(math.pi * (2 * x + 1) * u / 64) for x in range(32)] for u in range(8)]
+
+def get_dct_block(pixels):
+    # 8x8 lowest frequencies of the 2D DCT of a 32x32 block, given row by row
+    if numpy is not None:
+        basis = numpy.array(DCT_BASIS)
+        return (basis @ numpy.array(pixels, dtype=float).reshape(32, 32) @ basis.T).ravel().tolist()
+    rows = [pixels[y * 32:(y + 1) * 32] for y in range(32)]
+    columns = [[sum(b * p for b, p in zip(basis, row)) for basis in DCT_BASIS] for row in rows]
+    return [sum(DCT_BASIS[u][y] * columns[y][v] for y in range(32)) for u in range(8) for v in range(8)]
+
+def get_hash_bits(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | bit
+    return f"{value:016x}"
+
+def hash_image(file_path):
+    # aHash compares an 8x8 thumbnail with its mean, dHash each pixel with its
+    # right neighbour and pHash the 8x8 lowest DCT frequencies with their
+    # median. An image that cannot be decoded gets empty hashes, which keeps
+    # it from being retried until the file changes. The thumbnails are 'L',
+    # so tobytes() is one byte per pixel.
+    try:
+        with Image.open(file_path) as img:
+            img.draft('L', (64, 64))
+            img = ImageOps.exif_transpose(img).convert('L').resize((64, 64), Image.BOX)
+    except Exception:
+        return {'ahash': '', 'dhash': '', 'phash': ''}
+    pixels = list(img.resize((8, 8), Image.BOX).tobytes())
+    mean = sum(pixels) / 64
+    ahash = get_hash_bits(pixel > mean for pixel in pixels)
+    pixels = list(img.resize((9, 8), Image.BOX).tobytes())
+    dhash = get_hash_bits(pixels[y * 9 + x] > pixels[y * 9 + x + 1] for y in range(8) for x in range(8))
+    coefficients = get_dct_block(list(img.resize((32, 32), Image.LANCZOS).tobytes()))
+    median = sorted(coefficients[1:])[31]
+    phash = get_hash_bits(coefficient > median for coefficient in coefficients)
+    return {'ahash': ahash, 'dhash': dhash, 'phash': phash}
+
+def open_index():
+    global index_ready
+    conn = sqlite3.connect(os.path.join(SETTINGS_DIR, 'index.db'), timeout=30)
+    conn.row_factory = sqlite3.Row
+    if not index_ready:
+        if conn.execute('PRAGMA user_version').fetchone()[0] != INDEX_SCHEMA_VERSION:
+            conn.execute('DROP TABLE IF EXISTS images')
+            conn.execute('DROP TABLE IF EXISTS image_text')
+            conn.execute('DROP TABLE IF EXISTS state')
+            conn.execute('DROP TABLE IF EXISTS folders')
+            # directory is the library root and filename the path below it,
+            # with / as separator; folder is that path minus the file name.
+            conn.execute('''
+                CREATE TABLE images (
+                    directory TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    folder TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    width INTEGER,
+                    height INTEGER,
+                    format TEXT,
+                    mode TEXT,
+                    frames INTEGER,
+                    orientation INTEGER,
+                    taken_at TEXT,
+                    ahash TEXT,
+                    dhash TEXT,
+                    phash TEXT,
+                    PRIMARY KEY (directory, filename)
+                )
+            ''')
+            # Every folder below a root as of its last listing. mtime_ns is NULL
+            # for a folder that was listed too soon after it changed to trust it.
+            conn.execute('''
+                CREATE TABLE folders (
+                    directory TEXT NOT NULL,
+                    folder TEXT NOT NULL,
+                    mtime_ns INTEGER,
+                    PRIMARY KEY (directory, folder)
+                )
+            ''')
+            # One row per indexed image, sharing the rowid of its images row
+            conn.execute('''
+                CREATE VIRTUAL TABLE image_text USING fts5(
+                    filename, info, source, tags,
+                    prefix = '2 3'
+                )
+            ''')
+            # Small values that every worker process has to agree on
+            conn.execute('CREATE TABLE state (key TEXT PRIMARY KEY, value)')
+            conn.execute('CREATE INDEX images_folder ON images (directory, folder)')
+            # Rows still waiting for the probe and hash jobs
+            conn.execute('CREATE INDEX images_unprobed ON images (directory) WHERE format IS NULL')
+            conn.execute('CREATE INDEX images_unhashed ON images (directory) WHERE phash IS NULL')
+            conn.execute(f'PRAGMA user_version = {INDEX_SCHEMA_VERSION}')
+            conn.commit()
+        conn.execute('PRAGMA journal_mode = WAL')
+        index_ready = True
+    return conn
+
+def get_state(key, default=None):
+    conn = open_index()
+    try:
+        row = conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+    finally:
+        conn.close()
+    return default if row is None else row['value']
+
+def set_state(key, value):
+    conn = open_index()
+    try:
+        conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+        conn.commit()
+    finally:
+        conn.close()
+
+def advance_state(key, value):
+    # Stores value only if it is greater than the current one and reports
+    # whether it did, in one statement so concurrent workers cannot both win.
+    conn = open_index()
+    try:
+        cursor = conn.execute('''
+            INSERT INTO state (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value WHERE value < excluded.value
+        ''', (key, value))
+        conn.commit()
+        return cursor.rowcount > 0
+    finally:
+        conn.close()
+
+def increment_state(conn, key):
+    # Counts up a generation number as part of the caller's transaction, so it
+    # moves together with the rows it stands for
+    conn.execute('''
+        INSERT INTO state (key, value) VALUES (?, 1)
+        ON CONFLICT (key) DO UPDATE SET value = value + 1
+    ''', (key,))
+
+def get_library_generation():
+    # Moves whenever what the gallery shows may have changed: rows added,
+    # removed or rewritten by a scan, dimensions read by the probe job and
+    # info saved from any tab or process. Pages polling /check_updates send
+    # the generation they were built from.
+    return get_state('library_generation', 0)
+
+def advance_library_generation():
+    conn = open_index()
+    try:
+        increment_state(conn, 'library_generation')
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_library_roots(config):
+    # The library is image_directory plus any "extra_directories". Images below
+    # the first root use their path relative to it as ID, which keeps the IDs
+    # (and so the image_info) of a single-directory library unchanged. Images
+    # below any other root get an "N:" prefix, N being the root's position.
+    # A path below the first root that itself starts with "N:" is written
+    # "0:N:..." so that it cannot be read as an image of root N.
+    return [config.get('image_directory', '')] + list(config.get('extra_directories', []))
+
+ROOT_PREFIX = re.compile(r'(\d+):(.*)', re.S)
+
+# Configs written before first-root IDs got their "0:" have no
+# "image_id_version" and are migrated by migrate_image_ids when read
+IMAGE_ID_VERSION = 2
+
+def get_root_prefix(index):
+    return f"{index}:" if index else ''
+
+def get_root_prefixes(roots):
+    return {root: get_root_prefix(index) for index, root in enumerate(roots) if root}
+
+def make_image_id(prefix, filename):
+    if not prefix and ROOT_PREFIX.match(filename):
+        return '0:' + filename
+    return prefix + filename
+
+def split_image_id(image_id, root_count):
+    match = ROOT_PREFIX.match(image_id)
+    if match and int(match.group(1)) < root_count:
+        return int(match.group(1)), match.group(2)
+    return 0, image_id
+
+def migrate_image_ids(config):
+    # Moves the image_info of first-root files whose path starts with "N:" to
+    # the "0:" IDs make_image_id gives them now. Where root N has a file by
+    # the rest of that path too, both used to share the entry, so it stays
+    # and the first-root file gets a copy. Runs again harmlessly when replayed.
+    if config.get('image_id_version', 1) >= IMAGE_ID_VERSION:
+        return
+    roots = get_library_roots(config)
+    image_info = config.get('image_info', {})
+    for image_id in [image_id for image_id in image_info if ROOT_PREFIX.match(image_id)]:
+        if '0:' + image_id in image_info or not roots[0] or not os.path.isfile(get_folder_path(roots[0], image_id)):
+            continue
+        index, relative_path = split_image_id(image_id, len(roots))
+        if index and roots[index] and os.path.isfile(get_folder_path(roots[index], relative_path)):
+            image_info['0:' + image_id] = dict(image_info[image_id])
+        else:
+            image_info['0:' + image_id] = image_info.pop(image_id)
+    config['image_id_version'] = IMAGE_ID_VERSION
+
+def resolve_image_path(config, image_id):
+    # Returns (root, path below the root, file path) for an image ID, or None
+    # when the ID names no configured root, tries to step outside of it, or
+    # names a file the scan would not list: one inside a hidden folder or
+    # without an image extension.
+    roots = get_library_roots(config)
+    index, relative_path = split_image_id(image_id, len(roots))
+    if not roots[index]:
+        return None
+    *folders, name = relative_path.split('/')
+    if any(not folder or folder.startswith('.') for folder in folders) or not name.lower().endswith(IMAGE_EXTENSIONS):
+        return None
+    file_path = safe_join(roots[index], relative_path)
+    if file_path is None:
+        return None
+    return roots[index], relative_path, file_path
+
+def get_folder_path(root, folder):
+    return os.path.join(root, *folder.split('/')) if folder else root
+
+def mark_folder_dirty(folder_path):
+    with dirty_folders_lock:
+        dirty_folders.add(os.path.abspath(folder_path))
+
+def take_dirty_folders(root):
+    # Removes the dirty folders below root from the set and returns them as
+    # folder names relative to root.
+    root = os.path.abspath(root)
+    with dirty_folders_lock:
+        taken = {path for path in dirty_folders if path == root or path.startswith(root.rstrip(os.sep) + os.sep)}
+        dirty_folders.difference_update(taken)
+    folders = set()
+    for path in taken:
+        folder = os.path.relpath(path, root)
+        folders.add('' if folder == os.curdir else folder.replace(os.sep, '/'))
+    return folders
+
+def list_folder(directory_path):
+    # os.scandir hands back the stat data along with the directory entry, so
+    # listing a folder costs one pass instead of a listdir plus a stat per file.
+    # Hidden folders are skipped, as is the settings directory should it live
+    # inside the library, so thumbnails never end up in the index.
+    files = []
+    folders = []
+    settings_dir = os.path.abspath(SETTINGS_DIR) if SETTINGS_DIR else None
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.') and os.path.abspath(entry.path) != settings_dir:
+                        folders.append(entry.name)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                    files.append((entry.name, entry.stat()))
+            except OSError:
+                continue
+    files.sort()
+    folders.sort()
+    return files, folders
+
+def probe_images(paths, workers=SCAN_WORKERS, probe=probe_image):
+    # Yields probe results in the same order as paths while keeping at most a
+    # few jobs per worker in flight, so memory stays bounded on huge directories.
+    if workers <= 1:
+        for path in paths:
+            yield probe(path)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(probe, path))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def get_search_text(image_info, image_id):
+    info = image_info.get(image_id, {})
+    return info.get('info', ''), info.get('source', ''), info.get('tags', '')
+
+def update_index(root, prefix='', image_info=None, full=False):
+    # Brings the index up to date with everything below root and returns the
+    # newest folder mtime. A folder whose mtime still matches the one stored
+    # when it was last listed holds the same entries as back then, so it is
+    # neither listed nor read back from the index. Only folders that changed,
+    # or that the watcher marked dirty, are listed again; their files are
+    # queued for the probe and hash jobs if (size, mtime, inode) moved, and rows
+    # for files and folders that have disappeared are dropped. full=True lists
+    # every folder, as does the first scan of root after FULL_RESCAN_INTERVAL.
+    if image_info is None:
+        image_info = {}
+    dirty = take_dirty_folders(root)
+    racy_after = time.time_ns() - int(RACY_MTIME_WINDOW * 1e9)
+    with index_lock:
+        conn = open_index()
+        try:
+            # Recorded in the same transaction as the scan, so a scan that
+            # fails leaves the next one to be full
+            scan_key = f'last_full_scan:{root}'
+            last_full_scan = conn.execute('SELECT value FROM state WHERE key = ?', (scan_key,)).fetchone()
+            if full or last_full_scan is None or time.time() - last_full_scan['value'] >= FULL_RESCAN_INTERVAL:
+                full = True
+                conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (scan_key, time.time()))
+            known_folders = {row['folder']: row['mtime_ns'] for row in conn.execute(
+                'SELECT folder, mtime_ns FROM folders WHERE directory = ?', (root,))}
+            subfolders = {}
+            for folder in known_folders:
+                if folder:
+                    subfolders.setdefault(posixpath.dirname(folder), []).append(folder)
+
+            changed = []
+            added = []
+            removed = []
+            listed = []
+            visited = {}
+            stack = ['']
+            list_start = time.perf_counter()
+            while stack:
+                folder = stack.pop()
+                folder_path = get_folder_path(root, folder)
+                try:
+                    mtime_ns = os.stat(folder_path).st_mtime_ns
+                    if not full and folder not in dirty and known_folders.get(folder) == mtime_ns:
+                        visited[folder] = mtime_ns
+                        stack.extend(subfolders.get(folder, ()))
+                        continue
+                    files, folders = list_folder(folder_path)
+                except OSError:
+                    continue
+                visited[folder] = mtime_ns
+                listed.append((root, folder, mtime_ns if mtime_ns < racy_after else None))
+                rows = {row['filename']: row for row in conn.execute(
+                    'SELECT rowid, * FROM images WHERE directory = ? AND folder = ?', (root, folder))}
+                filenames = set()
+                for name, st in files:
+                    filename = f"{folder}/{name}" if folder else name
+                    filenames.add(filename)
+                    row = rows.get(filename)
+                    if row is not None and (row['size'], row['mtime_ns'], row['inode']) == (st.st_size, st.st_mtime_ns, st.st_ino):
+                        continue
+                    entry = {
+                        'directory': root,
+                        'filename': filename,
+                        'folder': folder,
+                        'size': st.st_size,
+                        'mtime_ns': st.st_mtime_ns,
+                        'inode': st.st_ino,
+                        'width': None,
+                        'height': None,
+                        'format': None,
+                        'mode': None,
+                        'frames': None,
+                        'orientation': None,
+                        'taken_at': None
+                    }
+                    changed.append(entry)
+                    if row is None:
+                        added.append(entry)
+                removed.extend((row['rowid'],) for filename, row in rows.items() if filename not in filenames)
+                stack.extend(f"{folder}/{name}" if folder else name for name in folders)
+            record_phase('list', time.perf_counter() - list_start)
+            # Folders whose stored mtime let the walk skip listing them
+            count_metric('gallery_cache_requests_total', len(visited) - len(listed), cache='folders', result='hit')
+            count_metric('gallery_cache_requests_total', len(listed), cache='folders', result='miss')
+
+            index_start = time.perf_counter()
+            if changed:
+                # An upsert keeps the rowid stable, and with it the image_text row
+                conn.executemany('''
+                    INSERT INTO images
+                        (directory, filename, folder, size, mtime_ns, inode, width, height, format, mode, frames, orientation, taken_at)
+                    VALUES
+                        (:directory, :filename, :folder, :size, :mtime_ns, :inode, :width, :height, :format, :mode, :frames, :orientation, :taken_at)
+                    ON CONFLICT (directory, filename) DO UPDATE SET
+                        size = excluded.size, mtime_ns = excluded.mtime_ns, inode = excluded.inode,
+                        width = excluded.width, height = excluded.height, format = excluded.format,
+                        mode = excluded.mode, frames = excluded.frames,
+                        orientation = excluded.orientation, taken_at = excluded.taken_at,
+                        ahash = NULL, dhash = NULL, phash = NULL
+                ''', changed)
+                conn.executemany('''
+                    INSERT INTO image_text (rowid, filename, info, source, tags)
+                    SELECT rowid, filename, ?, ?, ? FROM images WHERE directory = ? AND filename = ?
+                ''', [get_search_text(image_info, make_image_id(prefix, entry['filename'])) + (root, entry['filename'])
+                      for entry in added])
+            conn.executemany('DELETE FROM image_text WHERE rowid = ?', removed)
+            conn.executemany('DELETE FROM images WHERE rowid = ?', removed)
+            gone = [(root, folder) for folder in known_folders if folder not in visited]
+            conn.executemany('''
+                DELETE FROM image_text WHERE rowid IN (SELECT rowid FROM images WHERE directory = ? AND folder = ?)
+            ''', gone)
+            conn.executemany('DELETE FROM images WHERE directory = ? AND folder = ?', gone)
+            conn.executemany('DELETE FROM folders WHERE directory = ? AND folder = ?', gone)
+            conn.executemany('INSERT OR REPLACE INTO folders (directory, folder, mtime_ns) VALUES (?, ?, ?)', listed)
+            if changed or removed or gone:
+                increment_state(conn, 'hash_generation')
+                increment_state(conn, 'library_generation')
+            conn.commit()
+            record_phase('index', time.perf_counter() - index_start)
+        finally:
+            conn.close()
+    if changed:
+        request_probes()
+        request_hashes()
+    return max(visited.values()) / 1e9 if visited else None
+
+def get_file_version(size, mtime_ns, inode):
+    return f"{size:x}-{mtime_ns:x}-{inode:x}"
+
+class ImageRecord:
+    # One image of the catalog. The watcher keeps a record of every image in
+    # the library between scans, so records hold only what they cannot derive:
+    # info and source are the strings from image_info and tags the tuple of
+    # interned names from the tag index, all shared rather than copied, and the
+    # display fields are computed when the record is serialized by as_dict().
+    __slots__ = ('original', 'prefix_length', 'info', 'source', 'tags', 'width', 'height', 'size', 'mtime_ns', 'inode')
+
+    def __init__(self, original, prefix_length, info, source, tags, width, height, size, mtime_ns, inode):
+        self.original = original
+        self.prefix_length = prefix_length
+        self.info = info
+        self.source = source
+        self.tags = tags
+        self.width = width
+        self.height = height
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+
+    def __eq__(self, other):
+        if not isinstance(other, ImageRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    @property
+    def shortened(self):
+        return shorten_filename(posixpath.basename(self.original[self.prefix_length:]))
+
+    @property
+    def dimensions(self):
+        return format_dimensions(self.width, self.height)
+
+    @property
+    def modified(self):
+        return self.mtime_ns / 1e9
+
+    @property
+    def version(self):
+        return get_file_version(self.size, self.mtime_ns, self.inode)
+
+    def as_dict(self):
+        return {
+            'original': self.original,
+            'shortened': self.shortened,
+            'info': self.info,
+            'source': self.source,
+            'tags': list(self.tags),
+            'dimensions': self.dimensions,
+            'width': self.width,
+            'height': self.height,
+            'modified': self.modified,
+            'version': self.version
+        }
+
+def make_image_record(image_id, entry, image_info, image_tags):
+    info = image_info.get(image_id, {})
+    width, height = entry['width'], entry['height']
+    if entry['orientation'] in ROTATED_ORIENTATIONS:
+        width, height = height, width
+    # The ID is the root prefix followed by the filename
+    return ImageRecord(image_id, len(image_id) - len(entry['filename']), info.get('info', ''), info.get('source', ''), image_tags.get(image_id, ()),
+                       width, height, entry['size'], entry['mtime_ns'], entry['inode'])
+
+def get_library_images(roots, image_info):
     images = []
     all_tags = set()
-    if directory_path and os.path.exists(directory_path):
-        for filename in os.listdir(directory_path):
-            if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                shortened = shorten_filename(filename)
-                info = image_info.get(filename, {})
-                tags = [tag.strip() for tag in info.get('tags', '').split(',') if tag.strip()]
-                all_tags.update(tags)
-                file_path = os.path.join(directory_path, filename)
-                dimensions = get_image_dimensions(file_path)
-                images.append({
-                    'original': filename,
-                    'shortened': shortened,
-                    'info': info.get('info', ''),
-                    'source': info.get('source', ''),
-                    'tags': tags,
-                    'dimensions': dimensions
-                })
+    modified_times = []
+    image_tags = get_tags_by_image(image_info)
+    for index, root in enumerate(roots):
+        if not root or not os.path.isdir(root):
+            continue
+        prefix = get_root_prefix(index)
+        modified_time = update_index(root, prefix, image_info)
+        if modified_time is not None:
+            modified_times.append(modified_time)
+        conn = open_index()
+        try:
+            with time_phase('catalog'):
+                for row in conn.execute('SELECT * FROM images WHERE directory = ?', (root,)):
+                    image = make_image_record(make_image_id(prefix, row['filename']), row, image_info, image_tags)
+                    all_tags.update(image.tags)
+                    images.append(image)
+        finally:
+            conn.close()
+    last_scan['images'] = frozenset(image.original for image in images)
+    last_scan['roots'] = tuple(roots)
+    last_scan['modified_time'] = max(modified_times, default=None)
     return images, sorted(all_tags)
 
-def get_directory_modified_time(directory_path):
-    return os.path.getmtime(directory_path)
+def get_images_from_directory(directory_path, image_info):
+    return get_library_images([directory_path], image_info)
 
-@app.route('/', methods=['GET', 'POST'])
-def display_images():
-    global last_modified_time
-    
-    if SETTINGS_DIR is None:
-        return render_template_string(r'''
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Image Gallery - Configuration Required</title>
-                <style>
-                    body { font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f0f0f0; }
-                    h1 { color: #333; }
-                    .warning { color: #ff0000; font-weight: bold; }
-                    .info { color: #0000ff; }
-                    .code { font-family: monospace; background-color: #f0f0f0; padding: 2px 4px; }
-                </style>
-            </head>
-            <body>
-                <h1>Image Gallery - Configuration Required</h1>
-                <p class="warning">The SETTINGS_DIR is not configured. Please set it in the script before running.</p>
-                <p class="info">To configure the script:</p>
-                <ol>
-                    <li>Open the script in a text editor.</li>
-                    <li>Find the line <code class="code">SETTINGS_DIR = None</code></li>
-                    <li>Replace <code class="code">None</code> with the full path to your settings directory, using a raw string (prefix with r).</li>
-                    <li>Example for Unix/Linux: <code class="code">SETTINGS_DIR = r"/home/user/image_gallery_settings"</code></li>
-                    <li>Example for Windows: <code class="code">SETTINGS_DIR = r"C:\Users\user\image_gallery_settings"</code></li>
-                    <li>Save the script and run it again.</li>
-                    <li>The script will automatically create a config.json file in the specified directory.</li>
-                </ol>
-            </body>
-            </html>
-        ''')
-    
-    config = load_config()
+def parse_tags(tags):
+    return [tag.strip() for tag in tags.split(',') if tag.strip()]
+
+def index_image_tags(image_id, tags):
+    # Must be called with tag_index_lock held
+    for tag in tags_by_image.pop(image_id, ()):
+        postings = images_by_tag[tag]
+        postings.discard(image_id)
+        if not postings:
+            del images_by_tag[tag]
+    # Tuples of interned names, so that images sharing a tag share its string
+    # and catalog records can hold on to the tuple itself
+    tags = tuple(sys.intern(tag) for tag in parse_tags(tags))
+    if tags:
+        tags_by_image[image_id] = tags
+        for tag in tags:
+            images_by_tag.setdefault(tag, set()).add(image_id)
+
+def build_tag_index(image_info):
+    # Must be called with tag_index_lock held
+    global tag_index_source, tags_by_image, images_by_tag
+    if tag_index_source is image_info:
+        return
+    tags_by_image = {}
+    images_by_tag = {}
+    for image_id, info in list(image_info.items()):
+        index_image_tags(image_id, info.get('tags', ''))
+    tag_index_source = image_info
+
+def get_tags_by_image(image_info):
+    with tag_index_lock:
+        build_tag_index(image_info)
+        return tags_by_image
+
+def set_image_tags(image_info, image_id, tags):
+    with tag_index_lock:
+        if tag_index_source is image_info:
+            index_image_tags(image_id, tags)
+
+def query_tags(image_info, universe, all_tags=(), any_tags=(), none_tags=()):
+    # Boolean tag query answered from the postings: every tag in all_tags, at
+    # least one from any_tags and none from none_tags, restricted to universe.
+    with tag_index_lock:
+        build_tag_index(image_info)
+        if all_tags:
+            postings = sorted((images_by_tag.get(tag, set()) for tag in all_tags), key=len)
+            result = postings[0].intersection(*postings[1:])
+            result &= universe
+        elif any_tags:
+            result = set()
+        else:
+            result = set(universe)
+        if any_tags:
+            matches = set().union(*(images_by_tag.get(tag, set()) for tag in any_tags))
+            if all_tags:
+                result &= matches
+            else:
+                result = matches & universe
+        if none_tags:
+            result.difference_update(*(images_by_tag.get(tag, set()) for tag in none_tags))
+    return result
+
+def count_tags(image_ids, image_info):
+    image_tags = get_tags_by_image(image_info)
+    return Counter(tag for image_id in image_ids for tag in image_tags.get(image_id, ()))
+
+def match_tags(tags, all_tags=(), any_tags=(), none_tags=()):
+    # The per-image form of query_tags, for callers that see one image at a time
+    return (all(tag in tags for tag in all_tags)
+            and (not any_tags or any(tag in tags for tag in any_tags))
+            and not any(tag in tags for tag in none_tags))
+
+def get_tag_filters(args):
+    return tuple(parse_tags(args.get(name, '')) for name in ('all', 'any', 'none'))
+
+def sync_search_index(roots, image_info):
+    # The scan and save_image_info keep image_text current as they go; this
+    # catches up with edits made behind our back, i.e. after config.json was
+    # reloaded from disk, by diffing the stored text against image_info.
+    global search_index_source
+    roots = tuple(roots)
+    if search_index_source[0] == roots and search_index_source[1] is image_info:
+        return
+    with index_lock:
+        conn = open_index()
+        try:
+            inserts = []
+            updates = []
+            for root, prefix in get_root_prefixes(roots).items():
+                for row in conn.execute('''
+                    SELECT images.rowid AS rowid, images.filename AS filename, image_text.rowid AS text_rowid,
+                           image_text.info AS info, image_text.source AS source, image_text.tags AS tags
+                    FROM images LEFT JOIN image_text ON image_text.rowid = images.rowid
+                    WHERE images.directory = ?
+                ''', (root,)):
+                    text = get_search_text(image_info, make_image_id(prefix, row['filename']))
+                    if row['text_rowid'] is None:
+                        inserts.append((row['rowid'], row['filename']) + text)
+                    elif (row['info'], row['source'], row['tags']) != text:
+                        updates.append(text + (row['rowid'],))
+            conn.executemany('INSERT INTO image_text (rowid, filename, info, source, tags) VALUES (?, ?, ?, ?, ?)', inserts)
+            conn.executemany('UPDATE image_text SET info = ?, source = ?, tags = ? WHERE rowid = ?', updates)
+            conn.commit()
+        finally:
+            conn.close()
+    search_index_source = (roots, image_info)
+
+def set_search_text(directory_path, filename, info, source, tags):
+    set_search_texts([(directory_path, filename, info, source, tags)])
+
+def set_search_texts(entries):
+    # entries are (directory, filename, info, source, tags), all written in
+    # one transaction
+    with index_lock:
+        conn = open_index()
+        try:
+            conn.executemany('''
+                UPDATE image_text SET info = :info, source = :source, tags = :tags
+                WHERE rowid = (SELECT rowid FROM images WHERE directory = :directory AND filename = :filename)
+            ''', [{'directory': directory, 'filename': filename, 'info': info, 'source': source, 'tags': tags}
+                  for directory, filename, info, source, tags in entries])
+            conn.commit()
+        finally:
+            conn.close()
+
+def parse_image_edit(edit):
+    # Checks one edit for /bulk_edit and brings it into the form that
+    # apply_image_edits expects: image_ids plus any of info and source
+    # (strings), tags (replaces the list) and add_tags/remove_tags. Tags may be
+    # given as a list or as a comma separated string.
+    if not isinstance(edit, dict):
+        raise ValueError("Each edit must be an object")
+    unknown = set(edit) - set(IMAGE_EDIT_FIELDS) - {'image_id', 'image_ids'}
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    image_ids = edit.get('image_ids', [edit['image_id']] if 'image_id' in edit else [])
+    if not isinstance(image_ids, list) or not image_ids or not all(isinstance(image_id, str) and image_id for image_id in image_ids):
+        raise ValueError("Each edit needs image_id or a non-empty list of image_ids")
+    parsed = {'image_ids': image_ids}
+    for field in IMAGE_EDIT_FIELDS:
+        if field not in edit:
+            continue
+        value = edit[field]
+        if field in ('info', 'source'):
+            if not isinstance(value, str):
+                raise ValueError(f"{field} must be a string")
+        elif isinstance(value, str):
+            value = parse_tags(value)
+        elif not isinstance(value, list) or not all(isinstance(tag, str) for tag in value):
+            raise ValueError(f"{field} must be a list of tags or a comma separated string")
+        else:
+            value = [tag.strip() for tag in value if tag.strip()]
+        parsed[field] = value
+    if len(parsed) == 1:
+        raise ValueError(f"Each edit needs at least one of {', '.join(IMAGE_EDIT_FIELDS)}")
+    return parsed
+
+def apply_image_edits(image_info, edits):
+    # Applies parsed edits to image_info in order and returns the IDs of the
+    # images whose entry changed. Runs as an update_config mutator, so it
+    # leaves the tag index current along the way.
+    changed = set()
+    for edit in edits:
+        for image_id in edit['image_ids']:
+            entry = image_info.get(image_id, {'info': '', 'source': '', 'tags': ''})
+            updated = dict(entry)
+            for field in ('info', 'source'):
+                if field in edit:
+                    updated[field] = edit[field]
+            if 'tags' in edit or 'add_tags' in edit or 'remove_tags' in edit:
+                tags = edit.get('tags', parse_tags(entry.get('tags', '')))
+                tags = tags + [tag for tag in edit.get('add_tags', ()) if tag not in tags]
+                removed = set(edit.get('remove_tags', ()))
+                updated['tags'] = ', '.join(dict.fromkeys(tag for tag in tags if tag not in removed))
+            if updated != entry or image_id not in image_info:
+                image_info[image_id] = updated
+                set_image_tags(image_info, image_id, updated.get('tags', ''))
+                changed.add(image_id)
+    return changed
+
+def save_image_edits(edits):
+    # One config write and one index transaction for any number of edits
+    changed = set()
+    def edit_image_info(config):
+        changed.clear()
+        changed.update(apply_image_edits(config.setdefault('image_info', {}), edits))
+    config = update_config(edit_image_info)
     if config is None:
-        return "Failed to load or create configuration. Please check your settings directory permissions."
+        return None
+    entries = []
+    for image_id in sorted(changed):
+        location = resolve_image_path(config, image_id)
+        if location is not None:
+            entry = config['image_info'][image_id]
+            entries.append((location[0], location[1], entry.get('info', ''), entry.get('source', ''), entry.get('tags', '')))
+    if entries:
+        set_search_texts(entries)
+    if changed:
+        advance_library_generation()
+        notify_library_changed()
+    return changed
 
-    if request.method == 'POST':
-        new_image_dir = request.form['image_directory']
-        if os.path.exists(new_image_dir):
-            config['image_directory'] = new_image_dir
-            save_config(config)
-            last_modified_time = get_directory_modified_time(new_image_dir)
+def read_image_info_rows(stream, file_format):
+    # Yields (line number, row) from an import in JSONL or CSV, one row at a
+    # time. A row has image_id and any of info, source and tags.
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_format == 'csv':
+        reader = csv.DictReader(text)
+        if not reader.fieldnames or 'image_id' not in reader.fieldnames:
+            raise ValueError("The CSV header must name an image_id column")
+        for row in reader:
+            yield reader.line_num, {field: value for field, value in row.items() if field in IMAGE_INFO_FIELDS and value is not None}
+    else:
+        for line_number, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                raise ValueError(f"Line {line_number} is not valid JSON")
+            yield line_number, row
+
+def export_image_info(image_info, file_format):
+    # Yields image_info as JSONL or CSV in chunks of EXPORT_CHUNK entries
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if file_format == 'csv' else None
+    if writer is not None:
+        writer.writerow(IMAGE_INFO_FIELDS)
+    for i, image_id in enumerate(sorted(image_info), 1):
+        entry = image_info.get(image_id, {})
+        row = [image_id] + [entry.get(field, '') for field in IMAGE_INFO_FIELDS[1:]]
+        if writer is not None:
+            writer.writerow(row)
         else:
-            return f"The directory '{new_image_dir}' does not exist. Please enter a valid directory path."
-
-    images, all_tags = get_images_from_directory(config['image_directory'], config.get('image_info', {}))
-    last_modified_time = get_directory_modified_time(config['image_directory'])
-
-    return render_template_string(r'''
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Image Gallery</title>
-            <style>
-                body { font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f0f0f0; }
-                h1, h2 { color: #333; }
-                .form-container { margin-bottom: 20px; }
-                input[type="text"] { width: 300px; padding: 5px; }
-                input[type="submit"] { padding: 5px 10px; background-color: #4CAF50; color: white; border: none; cursor: pointer; }
-                .image-container { display: flex; flex-wrap: wrap; gap: 20px; }
-                .image-item { 
-                    background-color: white; 
-                    border: 1px solid #ddd; 
-                    border-radius: 4px; 
-                    padding: 10px; 
-                    box-shadow: 0 2px 4px rgba(0,0,0,0.1); 
-                    cursor: pointer; 
-                    position: relative;
-                    width: 220px;
-                    height: 220px;
-                    display: flex;
-                    flex-direction: column;
-                    justify-content: center;
-                    align-items: center;
-                }
-                .image-item img { 
-                    max-width: 200px; 
-                    max-height: 200px; 
-                    object-fit: contain;
-                }
-                .image-item p { margin: 10px 0 0; text-align: center; font-size: 14px; color: #666; }
-                .modal { display: none; position: fixed; z-index: 1; left: 0; top: 0; width: 100%; height: 100%; overflow: hidden; background-color: rgba(0,0,0,0.9); }
-                .modal-content { position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); max-height: 100vh; width: auto; }
-                .close { position: absolute; top: 15px; right: 35px; color: #f1f1f1; font-size: 40px; font-weight: bold; cursor: pointer; }
-                .menu-icon { position: absolute; top: 5px; right: 5px; background-color: rgba(255,255,255,0.7); border-radius: 50%; width: 24px; height: 24px; text-align: center; line-height: 24px; cursor: pointer; }
-                .menu-content { display: none; position: absolute; top: 30px; right: 5px; background-color: white; border: 1px solid #ddd; border-radius: 4px; padding: 10px; z-index: 1; }
-                .menu-content textarea, .menu-content input[type="text"] { width: 200px; margin-bottom: 5px; }
-                .menu-content textarea { height: 100px; }
-                .menu-content button { margin-top: 5px; }
-                .menu-content label { display: block; margin-top: 5px; }
-                .tag-list { margin-bottom: 20px; }
-                .tag { display: inline-block; background-color: #e0e0e0; padding: 5px 10px; margin: 2px; border-radius: 3px; cursor: pointer; }
-                .tag.active { background-color: #4CAF50; color: white; }
-                .button-container { display: flex; justify-content: space-between; margin-top: 10px; }
-                .button-container button { flex: 1; margin: 0 5px; }
-                .nav-button {
-                    position: absolute;
-                    top: 50%;
-                    transform: translateY(-50%);
-                    background-color: rgba(255,255,255,0.5);
-                    border: none;
-                    font-size: 24px;
-                    padding: 10px;
-                    cursor: pointer;
-                }
-                .nav-button:hover {
-                    background-color: rgba(255,255,255,0.8);
-                }
-                #prevButton { left: 10px; }
-                #nextButton { right: 10px; }
-                .tooltip { 
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    width: 100%;
-                    height: 100%;
-                }
-                .tooltip .tooltiptext { 
-                    visibility: hidden; 
-                    width: 120px; 
-                    background-color: rgba(0, 0, 0, 0.7); 
-                    color: #fff; 
-                    text-align: center; 
-                    border-radius: 6px; 
-                    padding: 5px 0; 
-                    position: absolute; 
-                    z-index: 1; 
-                    bottom: 100%; 
-                    left: 50%; 
-                    margin-left: -60px; 
-                    opacity: 0; 
-                    transition: opacity 0.3s;
-                }
-                .tooltip:hover .tooltiptext { 
-                    visibility: visible; 
-                    opacity: 1; 
-                }
-            </style>
-        </head>
-        <body>
-            <h1>Image Gallery</h1>
-            <div class="form-container">
-                <form method="post">
-                    <input type="text" name="image_directory" value="{{ image_directory }}" placeholder="Enter full image directory path">
-                    <input type="submit" value="Update Image Directory">
-                </form>
-            </div>
-            <h2>Images from: {{ image_directory }}</h2>
-            <div class="tag-list">
-                <strong>Tags:</strong>
-                {% for tag in all_tags %}
-                    <span class="tag" onclick="toggleTag(this)">{{ tag }}</span>
-                {% endfor %}
-            </div>
-            <div class="image-container">
-                {% for image in images %}
-                    <div class="image-item" data-tags="{{ image.tags|join(',') }}">
-                        <div class="tooltip">
-                            <img src="{{ url_for('serve_image', filename=image.original) }}" alt="{{ image.shortened }}" onclick="openModal('{{ url_for('serve_image', filename=image.original) }}')">
-                            <span class="tooltiptext">{{ image.dimensions }}</span>
-                        </div>
-                        <p title="{{ image.original }}">{{ image.shortened }}</p>
-                        <div class="menu-icon" onclick="toggleMenu('{{ image.original }}')">⋮</div>
-                        <div class="menu-content" id="menu-{{ image.original }}">
-                            <label for="info-{{ image.original }}">Information:</label>
-                            <textarea id="info-{{ image.original }}">{{ image.info }}</textarea>
-                            <label for="source-{{ image.original }}">Source:</label>
-                            <input type="text" id="source-{{ image.original }}" value="{{ image.source }}">
-                            <label for="tags-{{ image.original }}">Tags (comma separated):</label>
-                            <input type="text" id="tags-{{ image.original }}" value="{{ image.tags|join(', ') }}">
-                            <div class="button-container">
-                                <button onclick="saveImageInfo('{{ image.original }}')">Save</button>
-                                <button onclick="cancelEdit('{{ image.original }}')">Cancel</button>
-                            </div>
-                        </div>
-                    </div>
-                {% else %}
-                    <p>No images found in the specified directory.</p>
-                {% endfor %}
-            </div>
+            buffer.write(json.dumps(dict(zip(IMAGE_INFO_FIELDS, row))) + '\n')
+        if i % EXPORT_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
 
-            <div id="imageModal" class="modal">
-                <span class="close" onclick="closeModal()">&times;</span>
-                <button id="prevButton" class="nav-button" onclick="navigateImage(-1)">&lt;</button>
-                <img class="modal-content" id="modalImage">
-                <button id="nextButton" class="nav-button" onclick="navigateImage(1)">&gt;</button>
-            </div>
+def build_search_query(text, required_tags=()):
+    # Every word has to match somewhere, and each may be the start of a longer
+    # word. Quoting keeps FTS5 operators in user input from being interpreted.
+    # Required tags are added as phrases on the tags column so FTS5 narrows the
+    # candidates; exact tag matching is still left to the tag index.
+    terms = [f'"{term}"*' for term in re.findall(r'\w+', text)]
+    if terms:
+        for tag in required_tags:
+            words = re.findall(r'\w+', tag)
+            if words:
+                terms.append(f'tags : "{" ".join(words)}"')
+    return ' '.join(terms)
 
-            <script>
-                let currentImageIndex = 0;
-                let images = [{% for image in images %}'{{ url_for('serve_image', filename=image.original) }}'{% if not loop.last %}, {% endif %}{% endfor %}];
-                let imageInfo = {{ images|tojson|safe }};
-                let lastModifiedTime = {{ last_modified_time }};
-
-                function checkForUpdates() {
-                    fetch('/check_updates')
-                        .then(response => response.json())
-                        .then(data => {
-                            if (data.updated) {
-                                updateGallery();
-                            }
-                        });
-                }
+def search_images(roots, image_info, text, offset=0, limit=None, tag_filters=((), (), ())):
+    # Returns (rows, total) for one page of ranked results. Without tag filters
+    # the page is cut in SQL, so broad queries never materialize every match.
+    # CROSS JOIN pins image_text as the outer loop; otherwise SQLite may walk
+    # the library's rows and evaluate MATCH once per image.
+    query = build_search_query(text, tag_filters[0])
+    prefixes = get_root_prefixes(roots)
+    if not prefixes or not query:
+        return [], 0
+    sync_search_index(roots, image_info)
+    in_roots = f"images.directory IN ({', '.join('?' * len(prefixes))})"
+    ranked = f'''
+        FROM image_text CROSS JOIN images ON images.rowid = image_text.rowid
+        WHERE image_text MATCH ? AND {in_roots}
+        ORDER BY bm25(image_text, ?, ?, ?, ?), images.filename
+    '''
+    params = (query, *prefixes) + SEARCH_WEIGHTS
+    conn = open_index()
+    try:
+        if not any(tag_filters):
+            total = conn.execute(f'''
+                SELECT count(*) FROM image_text CROSS JOIN images ON images.rowid = image_text.rowid
+                WHERE image_text MATCH ? AND {in_roots}
+            ''', (query, *prefixes)).fetchone()[0]
+            rows = conn.execute(f'SELECT images.* {ranked} LIMIT ? OFFSET ?', params + (-1 if limit is None else limit, offset)).fetchall()
+            return rows, total
+        matches = conn.execute(f'SELECT images.rowid, images.directory, images.filename {ranked}', params).fetchall()
+        matches = [(row['rowid'], make_image_id(prefixes[row['directory']], row['filename'])) for row in matches]
+        allowed = query_tags(image_info, frozenset(image_id for rowid, image_id in matches), *tag_filters)
+        matches = [rowid for rowid, image_id in matches if image_id in allowed]
+        page = matches[offset:] if limit is None else matches[offset:offset + limit]
+        rows = {row['rowid']: row for row in conn.execute(
+            f"SELECT rowid, * FROM images WHERE rowid IN ({', '.join('?' * len(page))})", page)}
+        return [rows[rowid] for rowid in page], len(matches)
+    finally:
+        conn.close()
 
-                function updateGallery() {
-                    fetch('/get_images')
-                        .then(response => response.json())
-                        .then(data => {
-                            imageInfo = data.images;
-                            images = data.images.map(img => `/images/${img.original}`);
-                            updateImageContainer(data.images);
-                            updateTagList(data.all_tags);
-                            lastModifiedTime = data.last_modified_time;
-                        });
-                }
+def ensure_job_workers():
+    # Must be called with job_condition held
+    while len(job_threads) < JOB_WORKERS:
+        thread = threading.Thread(target=run_jobs, name=f'job-worker-{len(job_threads) + 1}', daemon=True)
+        job_threads.append(thread)
+        thread.start()
 
-                function updateImageContainer(newImages) {
-                    const container = document.querySelector('.image-container');
-                    container.innerHTML = '';
-                    newImages.forEach(image => {
-                        const imageItem = createImageItem(image);
-                        container.appendChild(imageItem);
-                    });
-                }
+def submit_job(kind, function, *args, key=None, priority=JOB_PRIORITY_NORMAL, description='', restart=False):
+    # Queues function(job, *args) and returns the job. If a job with the same
+    # key is still waiting, that one is returned instead, moved up if this
+    # submission asked for a higher priority. So is one that is running, unless
+    # it was cancelled; with restart=True it is run once more after it
+    # finishes, for jobs like probing that may already be past the work this
+    # submission is about.
+    with job_condition:
+        job = queued_jobs.get(key) if key is not None else None
+        running = running_jobs.get(key) if key is not None else None
+        if job is None and running is not None and not running['cancel_requested']:
+            running['restart'] = running['restart'] or restart
+            return running
+        if job is not None:
+            if priority < job['priority']:
+                job['priority'] = priority
+                heapq.heappush(job_queue, (priority, next(job_sequence), job['id']))
+                job_condition.notify()
+            return job
+        job = {
+            'id': next(job_sequence),
+            'kind': kind,
+            'key': key,
+            'description': description,
+            'priority': priority,
+            'state': 'queued',
+            'progress': 0,
+            'total': None,
+            'error': None,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'function': function,
+            'args': args,
+            'steps': None,
+            'result': None,
+            'cancel_requested': False,
+            'restart': False,
+            'completed': threading.Event()
+        }
+        jobs[job['id']] = job
+        if key is not None:
+            queued_jobs[key] = job
+        heapq.heappush(job_queue, (priority, job['id'], job['id']))
+        ensure_job_workers()
+        job_condition.notify()
+    return job
 
-                function createImageItem(image) {
-                    const imageItem = document.createElement('div');
-                    imageItem.className = 'image-item';
-                    imageItem.dataset.tags = image.tags.join(',');
-                    imageItem.innerHTML = `
-                        <div class="tooltip">
-                            <img src="/images/${image.original}" alt="${image.shortened}" onclick="openModal('/images/${image.original}')">
-                            <span class="tooltiptext">${image.dimensions}</span>
-                        </div>
-                        <p title="${image.original}">${image.shortened}</p>
-                        <div class="menu-icon" onclick="toggleMenu('${image.original}')">⋮</div>
-                        <div class="menu-content" id="menu-${image.original}">
-                            <label for="info-${image.original}">Information:</label>
-                            <textarea id="info-${image.original}">${image.info}</textarea>
-                            <label for="source-${image.original}">Source:</label>
-                            <input type="text" id="source-${image.original}" value="${image.source}">
-                            <label for="tags-${image.original}">Tags (comma separated):</label>
-                            <input type="text" id="tags-${image.original}" value="${image.tags.join(', ')}">
-                            <div class="button-container">
-                                <button onclick="saveImageInfo('${image.original}')">Save</button>
-                                <button onclick="cancelEdit('${image.original}')">Cancel</button>
-                            </div>
-                        </div>
-                    `;
-                    return imageItem;
-                }
+def finish_job(job, state):
+    # Must be called with job_condition held. Only the last JOB_HISTORY
+    # finished jobs are kept around for /jobs.
+    if job['steps'] is not None:
+        job['steps'].close()
+    job['state'] = state
+    job['finished_at'] = time.time()
+    job['function'] = job['args'] = job['steps'] = None
+    job['completed'].set()
+    finished_jobs.append(job['id'])
+    while len(finished_jobs) > JOB_HISTORY:
+        jobs.pop(finished_jobs.popleft(), None)
+
+def run_job_step(job):
+    # Runs the job until it is finished, which returns True, or until a job
+    # written as a generator yields while a more urgent one is waiting.
+    if job['steps'] is None:
+        result = job['function'](job, *job['args'])
+        if not inspect.isgenerator(result):
+            job['result'] = result
+            return True
+        job['steps'] = result
+    try:
+        while True:
+            next(job['steps'])
+            if job['cancel_requested']:
+                return True
+            with job_condition:
+                if jobs_stopping or (job_queue and job_queue[0][0] < job['priority']):
+                    return False
+    except StopIteration as stop:
+        job['result'] = stop.value
+        return True
+
+def run_jobs():
+    while True:
+        with job_condition:
+            job = None
+            while job is None:
+                while not job_queue and not jobs_stopping:
+                    job_condition.wait()
+                if jobs_stopping:
+                    return
+                priority, sequence, job_id = heapq.heappop(job_queue)
+                # Cancelled jobs and the old entries of reprioritized ones
+                job = jobs.get(job_id)
+                if job is not None and job['state'] != 'queued':
+                    job = None
+            job['state'] = 'running'
+            job['started_at'] = job['started_at'] or time.time()
+            if queued_jobs.get(job['key']) is job:
+                del queued_jobs[job['key']]
+            if job['key'] is not None:
+                running_jobs[job['key']] = job
+        try:
+            finished = run_job_step(job)
+            state = 'cancelled' if job['cancel_requested'] else 'done'
+        except Exception as e:
+            if jobs_stopping:
+                # The interpreter is going away underneath the job
+                return
+            app.logger.exception(f"Job {job['id']} ({job['kind']}) failed")
+            job['error'] = str(e)
+            finished = True
+            state = 'failed'
+        with job_condition:
+            if running_jobs.get(job['key']) is job:
+                del running_jobs[job['key']]
+            if finished:
+                restart = (job['function'], job['args']) if job['restart'] and state == 'done' else None
+                finish_job(job, state)
+                if restart:
+                    submit_job(job['kind'], restart[0], *restart[1], key=job['key'], priority=job['priority'], description=job['description'])
+            else:
+                job['state'] = 'queued'
+                if job['key'] is not None:
+                    queued_jobs.setdefault(job['key'], job)
+                heapq.heappush(job_queue, (job['priority'], next(job_sequence), job['id']))
+                if jobs_stopping:
+                    return
+
+def stop_job_workers():
+    # Lets the workers finish the step they are in and stops them before
+    # concurrent.futures shuts its executors down at exit, which would make
+    # the batch a hash or probe job is in the middle of fail. It learns of
+    # the exit through threading's hook, and hooks run newest first.
+    global jobs_stopping
+    with job_condition:
+        jobs_stopping = True
+        job_condition.notify_all()
+    deadline = time.monotonic() + JOB_STOP_TIMEOUT
+    for thread in job_threads:
+        thread.join(max(0, deadline - time.monotonic()))
+
+getattr(threading, '_register_atexit', atexit.register)(stop_job_workers)
+
+def cancel_job(job_id):
+    # A queued job is dropped right away; a running one is asked to stop and
+    # does so the next time it checks job['cancel_requested'].
+    with job_condition:
+        job = jobs.get(job_id)
+        if job is None:
+            return None
+        if job['state'] == 'queued':
+            if queued_jobs.get(job['key']) is job:
+                del queued_jobs[job['key']]
+            finish_job(job, 'cancelled')
+        elif job['state'] == 'running':
+            job['cancel_requested'] = True
+        return job
+
+def set_job_progress(job, progress, total=None):
+    job['progress'] = progress
+    job['total'] = total
+
+def wait_for_job(job, timeout=None):
+    # Returns the job's result, or None if it failed or did not finish in time
+    if job['completed'].wait(timeout) and job['state'] == 'done':
+        return job['result']
+    return None
+
+def get_job_status(job):
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'description': job['description'],
+        'priority': job['priority'],
+        'state': job['state'],
+        'progress': job['progress'],
+        'total': job['total'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at']
+    }
+
+def count_pending_images(roots, column):
+    directories = [root for root in roots if root]
+    if not directories:
+        return 0
+    conn = open_index()
+    try:
+        return conn.execute(f'''
+            SELECT count(*) FROM images
+            WHERE {column} IS NULL AND directory IN ({', '.join('?' * len(directories))})
+        ''', directories).fetchone()[0]
+    finally:
+        conn.close()
 
-                function updateTagList(newTags) {
-                    const tagList = document.querySelector('.tag-list');
-                    tagList.innerHTML = '<strong>Tags:</strong> ';
-                    newTags.forEach(tag => {
-                        const tagSpan = document.createElement('span');
-                        tagSpan.className = 'tag';
-                        tagSpan.textContent = tag;
-                        tagSpan.onclick = function() { toggleTag(this); };
-                        tagList.appendChild(tagSpan);
-                    });
+def probe_pending_images(roots, workers=SCAN_WORKERS):
+    # Reads the headers of one batch of images the scan has queued and returns
+    # how many rows were stored. An unreadable image gets an empty format, so
+    # it is not retried until the file changes; a row whose file changed
+    # while it was being probed is left for the rescan that notices.
+    directories = [root for root in roots if root]
+    if not directories:
+        return 0
+    conn = open_index()
+    try:
+        rows = conn.execute(f'''
+            SELECT rowid, directory, filename, size, mtime_ns, inode FROM images
+            WHERE format IS NULL AND directory IN ({', '.join('?' * len(directories))})
+            LIMIT ?
+        ''', directories + [PROBE_BATCH]).fetchall()
+    finally:
+        conn.close()
+    paths = [get_folder_path(row['directory'], row['filename']) for row in rows]
+    with time_phase('probe'):
+        updates = [(probe['width'], probe['height'], probe['format'] or '', probe['mode'], probe['frames'],
+                    probe['orientation'], probe['taken_at'], row['rowid'], row['size'], row['mtime_ns'], row['inode'])
+                   for row, probe in zip(rows, probe_images(paths, workers))]
+    failed = sum(1 for update in updates if not update[2])
+    count_metric('gallery_files_probed_total', len(updates) - failed, result='ok')
+    count_metric('gallery_files_probed_total', failed, result='failed')
+    with index_lock:
+        conn = open_index()
+        try:
+            stored = 0
+            for update in updates:
+                stored += conn.execute('''
+                    UPDATE images SET width = ?, height = ?, format = ?, mode = ?, frames = ?, orientation = ?, taken_at = ?
+                    WHERE rowid = ? AND size = ? AND mtime_ns = ? AND inode = ?
+                ''', update).rowcount
+            if stored:
+                increment_state(conn, 'library_generation')
+            conn.commit()
+        finally:
+            conn.close()
+    if stored:
+        # Lets the watcher push the new dimensions to open pages
+        notify_library_changed()
+    return stored
+
+def hash_pending_images(roots, workers=SCAN_WORKERS):
+    # Hashes one batch of images that have no hashes yet and returns how many
+    # were stored. A row whose file changed while it was being hashed is left
+    # alone; the rescan that notices the change queues it again.
+    directories = [root for root in roots if root]
+    if not directories:
+        return 0
+    conn = open_index()
+    try:
+        rows = conn.execute(f'''
+            SELECT rowid, directory, filename, size, mtime_ns, inode FROM images
+            WHERE phash IS NULL AND directory IN ({', '.join('?' * len(directories))})
+            LIMIT ?
+        ''', directories + [HASH_BATCH]).fetchall()
+    finally:
+        conn.close()
+    paths = [get_folder_path(row['directory'], row['filename']) for row in rows]
+    with time_phase('hash'):
+        updates = [(hashes['ahash'], hashes['dhash'], hashes['phash'], row['rowid'], row['size'], row['mtime_ns'], row['inode'])
+                   for row, hashes in zip(rows, probe_images(paths, workers, hash_image))]
+    failed = sum(1 for update in updates if not update[2])
+    count_metric('gallery_files_hashed_total', len(updates) - failed, result='ok')
+    count_metric('gallery_files_hashed_total', failed, result='failed')
+    with index_lock:
+        conn = open_index()
+        try:
+            stored = 0
+            for update in updates:
+                stored += conn.execute('''
+                    UPDATE images SET ahash = ?, dhash = ?, phash = ?
+                    WHERE rowid = ? AND size = ? AND mtime_ns = ? AND inode = ?
+                ''', update).rowcount
+            if stored:
+                increment_state(conn, 'hash_generation')
+            conn.commit()
+        finally:
+            conn.close()
+    return stored
+
+def drain_pending_images(job, column, process_batch):
+    # Job body shared by probing and hashing: runs process_batch until no row
+    # is left with column unset, reporting progress and yielding between batches.
+    config = load_config()
+    if not config:
+        return 0
+    roots = get_library_roots(config)
+    workers = config.get('scan_workers') or SCAN_WORKERS
+    processed = 0
+    while not job['cancel_requested']:
+        pending = count_pending_images(roots, column)
+        set_job_progress(job, processed, processed + pending)
+        if not pending:
+            break
+        stored = process_batch(roots, workers)
+        if not stored:
+            break
+        processed += stored
+        yield
+    return processed
+
+def request_probes():
+    if BACKGROUND_JOBS:
+        submit_job('probe', drain_pending_images, 'format', probe_pending_images,
+                   key='probe', description="Reading image headers", restart=True)
+
+def request_hashes():
+    if BACKGROUND_JOBS:
+        submit_job('hash', drain_pending_images, 'phash', hash_pending_images,
+                   key='hash', priority=JOB_PRIORITY_LOW, description="Computing perceptual hashes", restart=True)
+
+def get_hash_chunk_masks(max_bits):
+    # Every 16-bit mask with at most max_bits bits set
+    masks = [0]
+    for bits in range(1, max_bits + 1):
+        masks.extend(mask for mask in range(1 << 16) if mask.bit_count() == bits)
+    return masks
+
+def search_duplicate_clusters(hashes, max_distance=DUPLICATE_DISTANCE, job=None):
+    # Groups image IDs whose hashes are within max_distance bits of each other,
+    # directly or through a chain of such pairs. Comparing every pair would be
+    # quadratic, so this uses multi-index hashing: each 64-bit hash is split
+    # into four 16-bit chunks, and by pigeonhole two hashes within
+    # max_distance share a chunk that differs in at most max_distance // 4
+    # bits. Only hashes found in those neighbouring chunk buckets are compared.
+    # A generator that yields every DUPLICATE_BATCH hashes and returns the
+    # clusters, so that a job can run it a step at a time.
+    ids_by_hash = {}
+    for image_id, value in hashes.items():
+        ids_by_hash.setdefault(value, []).append(image_id)
+    values = list(ids_by_hash)
+    masks = get_hash_chunk_masks(max_distance // 4)
+    buckets = [{}, {}, {}, {}]
+    parents = list(range(len(values)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, value in enumerate(values):
+        if i and i % DUPLICATE_BATCH == 0:
+            if job is not None:
+                set_job_progress(job, i, len(values))
+            yield
+        chunks = [(value >> shift) & 0xffff for shift in (0, 16, 32, 48)]
+        candidates = set()
+        for chunk, bucket in zip(chunks, buckets):
+            for mask in masks:
+                candidates.update(bucket.get(chunk ^ mask, ()))
+        for j in candidates:
+            if (value ^ values[j]).bit_count() <= max_distance:
+                parents[find(j)] = find(i)
+        for chunk, bucket in zip(chunks, buckets):
+            bucket.setdefault(chunk, []).append(i)
+
+    clusters = {}
+    for i, value in enumerate(values):
+        clusters.setdefault(find(i), []).extend(ids_by_hash[value])
+    return sorted((sorted(cluster) for cluster in clusters.values() if len(cluster) > 1),
+                  key=lambda cluster: (-len(cluster), cluster[0]))
+
+def find_duplicate_clusters(hashes, max_distance=DUPLICATE_DISTANCE):
+    # search_duplicate_clusters run to the end in one go
+    steps = search_duplicate_clusters(hashes, max_distance)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+def search_duplicates(job, roots, kind, max_distance):
+    # Job body for get_duplicate_clusters. The generation is read before the
+    # hashes, so clusters from hashes that changed in between are stored under
+    # a generation that is already out of date and never served.
+    key = (tuple(roots), kind, max_distance)
+    generation = get_state('hash_generation', 0)
+    with duplicates_lock:
+        if duplicates_cache['generation'] == generation and key in duplicates_cache['searches']:
+            return duplicates_cache['searches'][key]
+    prefixes = get_root_prefixes(roots)
+    hashes = {}
+    if prefixes:
+        conn = open_index()
+        try:
+            for row in conn.execute(f'''
+                SELECT directory, filename, {kind} FROM images
+                WHERE {kind} != '' AND directory IN ({', '.join('?' * len(prefixes))})
+            ''', list(prefixes)):
+                hashes[make_image_id(prefixes[row['directory']], row['filename'])] = int(row[kind], 16)
+        finally:
+            conn.close()
+    with time_phase('duplicates'):
+        clusters = yield from search_duplicate_clusters(hashes, max_distance, job)
+    result = (clusters, len(hashes))
+    with duplicates_lock:
+        if duplicates_cache['generation'] is None or duplicates_cache['generation'] < generation:
+            duplicates_cache['generation'] = generation
+            duplicates_cache['searches'].clear()
+        if duplicates_cache['generation'] == generation:
+            searches = duplicates_cache['searches']
+            searches[key] = result
+            searches.move_to_end(key)
+            while len(searches) > DUPLICATE_SEARCHES:
+                searches.popitem(last=False)
+    return result
+
+def get_duplicate_clusters(roots, kind='phash', max_distance=DUPLICATE_DISTANCE):
+    # Returns (clusters, number of hashed images, job). Clusters are reused for
+    # as long as no hash has changed; otherwise a job groups them again, and
+    # if it has not finished after DUPLICATE_WAIT seconds the clusters are None
+    # and the job tells how far it got.
+    key = (tuple(roots), kind, max_distance)
+    generation = get_state('hash_generation', 0)
+    with duplicates_lock:
+        result = duplicates_cache['searches'].get(key) if duplicates_cache['generation'] == generation else None
+        if result is not None:
+            duplicates_cache['searches'].move_to_end(key)
+    count_metric('gallery_cache_requests_total', cache='duplicates', result='miss' if result is None else 'hit')
+    if result is not None:
+        return result + (None,)
+    job = submit_job('duplicates', search_duplicates, roots, kind, max_distance,
+                     key=('duplicates',) + key, description=f"Grouping near-duplicates by {kind}")
+    result = wait_for_job(job, DUPLICATE_WAIT)
+    if result is None:
+        return None, None, job
+    return result + (job,)
+
+def get_page_arguments(args):
+    sort = args.get('sort', 'name')
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort order '{sort}'")
+    order = args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        raise ValueError(f"Unknown order '{order}'")
+    offset = args.get('offset', 0, type=int)
+    limit = args.get('limit', None, type=int)
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("offset and limit must not be negative")
+    return sort, order, offset, limit
+
+def paginate_images(images, sort='name', order='asc', offset=0, limit=None):
+    images = sorted(images, key=SORT_KEYS[sort], reverse=(order == 'desc'))
+    end = len(images) if limit is None else min(offset + limit, len(images))
+    return images[offset:end], (end if end < len(images) else None)
+
+def stream_library_page(roots, image_info, sort='name', order='asc', offset=0, limit=None, tag_filters=((), (), ())):
+    # Generator behind /get_images?stream=1: brings the index up to date, then
+    # yields one NDJSON line per image on the page followed by a summary line
+    # carrying what /get_images returns besides the images. Rows are sorted by
+    # SQLite and read from a cursor, and tags are only counted, so memory use
+    # stays the same however large the library is.
+    # Read first, so that a change made while the page is read is newer
+    generation = get_library_generation()
+    modified_times = []
+    for index, root in enumerate(roots):
+        if root and os.path.isdir(root):
+            modified_time = update_index(root, get_root_prefix(index), image_info)
+            if modified_time is not None:
+                modified_times.append(modified_time)
+    prefixes = get_root_prefixes(roots)
+    image_tags = get_tags_by_image(image_info)
+    tag_counts = Counter()
+    total = 0
+    end = None if limit is None else offset + limit
+    if prefixes:
+        direction = 'DESC' if order == 'desc' else 'ASC'
+        conn = open_index()
+        try:
+            conn.create_function('image_id', 2, lambda directory, filename: make_image_id(prefixes[directory], filename), deterministic=True)
+            conn.create_function('py_lower', 1, str.lower, deterministic=True)
+            cursor = conn.execute(f'''
+                SELECT *, image_id(directory, filename) AS id FROM images
+                WHERE directory IN ({', '.join('?' * len(prefixes))})
+                ORDER BY {', '.join(f'{key} {direction}' for key in SQL_SORT_KEYS[sort])}
+            ''', list(prefixes))
+            for row in cursor:
+                tags = image_tags.get(row['id'], ())
+                tag_counts.update(tags)
+                if not match_tags(tags, *tag_filters):
+                    continue
+                if total >= offset and (end is None or total < end):
+                    yield json.dumps(make_image_record(row['id'], row, image_info, image_tags).as_dict()) + '\n'
+                total += 1
+        finally:
+            conn.close()
+    last_modified_time = max(modified_times, default=None)
+    if offset == 0 and last_modified_time is not None:
+        # The gallery page loads its first page from here; /check_updates
+        # compares against what that page has seen
+        set_state('last_modified_time', last_modified_time)
+    yield json.dumps({'summary': {
+        'all_tags': sorted(tag_counts),
+        'tag_counts': tag_counts,
+        'total': total,
+        'offset': offset,
+        'next_offset': end if end is not None and end < total else None,
+        'last_modified_time': last_modified_time,
+        'generation': generation
+    }}) + '\n'
+
+def get_thumbnail_dir():
+    return os.path.join(SETTINGS_DIR, 'thumbs')
+
+def get_thumbnail_key(file_path, st, size=THUMBNAIL_SIZE):
+    # The key is derived from the identity of the source file and the rendition
+    # settings, so a changed original simply maps to a new cache entry and the
+    # stale one ages out through eviction.
+    identity = f"{os.path.abspath(file_path)}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}\0{size[0]}x{size[1]}\0{THUMBNAIL_FORMAT}"
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+def get_thumbnail_path(key):
+    extension = '.webp' if THUMBNAIL_FORMAT == 'WEBP' else '.jpg'
+    return os.path.join(get_thumbnail_dir(), key[:2], key + extension)
+
+def render_thumbnail(file_path, thumbnail_path, size=THUMBNAIL_SIZE):
+    with Image.open(file_path) as img:
+        img.draft('RGB', size)
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(size, Image.LANCZOS)
+        has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+        if THUMBNAIL_FORMAT == 'WEBP' and has_alpha:
+            img = img.convert('RGBA')
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(thumbnail_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img.save(f, THUMBNAIL_FORMAT, quality=80)
+            os.replace(temp_path, thumbnail_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    return os.path.getsize(thumbnail_path)
+
+def evict_thumbnails(added_bytes):
+    # Least-recently-used eviction: every cache hit bumps the file's mtime, so
+    # the oldest mtimes are the entries nobody has asked for in the longest time.
+    global thumbnail_cache_size
+    with thumbnail_lock:
+        if thumbnail_cache_size is None:
+            thumbnail_cache_size = 0
+            for root, dirs, files in os.walk(get_thumbnail_dir()):
+                for name in files:
+                    thumbnail_cache_size += os.path.getsize(os.path.join(root, name))
+        else:
+            thumbnail_cache_size += added_bytes
+        if thumbnail_cache_size <= THUMBNAIL_CACHE_LIMIT:
+            return
+        entries = []
+        for root, dirs, files in os.walk(get_thumbnail_dir()):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        target = THUMBNAIL_CACHE_LIMIT * 0.9
+        thumbnail_cache_size = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if thumbnail_cache_size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            thumbnail_cache_size -= size
+
+def get_cached_thumbnail(key):
+    thumbnail_path = get_thumbnail_path(key)
+    try:
+        os.utime(thumbnail_path)
+        return thumbnail_path
+    except FileNotFoundError:
+        return None
+
+def get_thumbnail(file_path, st, key, size=THUMBNAIL_SIZE):
+    thumbnail_path = get_cached_thumbnail(key)
+    if thumbnail_path is not None:
+        return thumbnail_path
+    thumbnail_path = get_thumbnail_path(key)
+    try:
+        with time_phase('thumbnail' if size == THUMBNAIL_SIZE else 'screen'):
+            added_bytes = render_thumbnail(file_path, thumbnail_path, size)
+    except Exception:
+        return None
+    evict_thumbnails(added_bytes)
+    return thumbnail_path
+
+def get_indexed_size(directory_path, filename):
+    # The index row (width, height) of an image, or None when the scan has not
+    # indexed it; only indexed images are served, so a path the scan skips,
+    # like the settings directory inside the library, cannot be fetched
+    conn = open_index()
+    try:
+        return conn.execute('SELECT width, height FROM images WHERE directory = ? AND filename = ?',
+                            (directory_path, filename)).fetchone()
+    finally:
+        conn.close()
+
+def fits_screen(row):
+    # Whether the index has the image down as no larger than SCREEN_SIZE
+    return row['width'] is not None and row['width'] <= SCREEN_SIZE[0] and row['height'] <= SCREEN_SIZE[1]
+
+def get_library_modified_time(roots):
+    # Newest mtime among the roots and every folder the index knows below
+    # them, which moves whenever a file is added, removed or renamed anywhere
+    # in the library. Costs one stat per folder rather than one per file.
+    directories = [root for root in roots if root]
+    if not directories:
+        return None
+    conn = open_index()
+    try:
+        folders = conn.execute(f"SELECT directory, folder FROM folders WHERE directory IN ({', '.join('?' * len(directories))})",
+                               directories).fetchall()
+    finally:
+        conn.close()
+    modified_times = []
+    for path in directories + [get_folder_path(row['directory'], row['folder']) for row in folders if row['folder']]:
+        try:
+            modified_times.append(os.stat(path).st_mtime_ns / 1e9)
+        except OSError:
+            continue
+    return max(modified_times, default=None)
+
+def diff_snapshots(old, new):
+    changes = {'added': [], 'removed': [], 'modified': [], 'metadata': []}
+    for image_id in sorted(new):
+        image = new[image_id]
+        previous = old.get(image_id)
+        if previous is None:
+            changes['added'].append(image.as_dict())
+        elif previous != image:
+            file_fields = ('width', 'height', 'mtime_ns')
+            if any(getattr(previous, field) != getattr(image, field) for field in file_fields):
+                changes['modified'].append(image.as_dict())
+            else:
+                changes['metadata'].append(image.as_dict())
+    changes['removed'] = sorted(image_id for image_id in old if image_id not in new)
+    return changes
+
+def subscribe():
+    # Returns None once EVENT_STREAM_LIMIT streams are open
+    subscriber = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+    with subscribers_lock:
+        if EVENT_STREAM_LIMIT is not None and len(subscribers) >= EVENT_STREAM_LIMIT:
+            return None
+        subscribers.append(subscriber)
+    return subscriber
+
+def unsubscribe(subscriber):
+    with subscribers_lock:
+        if subscriber in subscribers:
+            subscribers.remove(subscriber)
+
+def publish_event(event_type, data):
+    with subscribers_lock:
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event_type, data))
+            except queue.Full:
+                # A client this far behind is better off refetching everything
+                while not subscriber.empty():
+                    subscriber.get_nowait()
+                subscriber.put_nowait(('resync', {}))
+
+def notify_library_changed():
+    library_changed.set()
+
+class LibraryEventHandler:
+    # watchdog only needs a dispatch() method, so this works without importing
+    # its handler base class. With a filename set, only events touching that
+    # file count; otherwise the folders the event happened in are marked dirty
+    # so the next scan lists them.
+    def __init__(self, filename=None):
+        self.filename = filename
+
+    def dispatch(self, event):
+        # Reading a file (e.g. to render its thumbnail) changes nothing
+        if event.event_type in ('opened', 'closed_no_write'):
+            return
+        paths = [path for path in (event.src_path, getattr(event, 'dest_path', None)) if path]
+        if self.filename is not None:
+            if self.filename not in (os.path.basename(path) for path in paths):
+                return
+        else:
+            for path in paths:
+                mark_folder_dirty(os.path.dirname(path))
+        notify_library_changed()
+
+def watch_library():
+    observer = None
+    watched_roots = None
+    snapshot = None
+    while True:
+        try:
+            config = load_config()
+            roots = tuple(get_library_roots(config)) if config else ()
+            if not any(root and os.path.isdir(root) for root in roots):
+                roots = ()
+
+            if roots != watched_roots:
+                if observer is not None:
+                    observer.stop()
+                    observer = None
+                if Observer is not None and roots:
+                    observer = Observer()
+                    for root in roots:
+                        if root and os.path.isdir(root):
+                            observer.schedule(LibraryEventHandler(), root, recursive=True)
+                    # Edits saved by other worker processes arrive through config.json
+                    observer.schedule(LibraryEventHandler('config.json'), os.path.abspath(SETTINGS_DIR), recursive=False)
+                    observer.start()
+                if snapshot is not None:
+                    publish_event('resync', {})
+                watched_roots = roots
+                snapshot = None
+
+            if roots:
+                generation = get_library_generation()
+                images, all_tags = get_library_images(roots, config.get('image_info', {}))
+                current = {image.original: image for image in images}
+                if snapshot is not None:
+                    changes = diff_snapshots(snapshot, current)
+                    if any(changes.values()):
+                        changes['all_tags'] = all_tags
+                        changes['tag_counts'] = count_tags(current, config.get('image_info', {}))
+                        changes['total'] = len(images)
+                        changes['last_modified_time'] = last_scan['modified_time']
+                        changes['generation'] = generation
+                        publish_event('changes', changes)
+                snapshot = current
+        except Exception:
+            app.logger.exception("Library watcher failed to rescan")
+
+        library_changed.wait(WATCH_IDLE_INTERVAL if observer is not None else WATCH_POLL_INTERVAL)
+        # Let a burst of filesystem events settle into a single rescan
+        time.sleep(WATCH_DEBOUNCE)
+        library_changed.clear()
+
+def ensure_watcher():
+    global watcher_thread
+    with watcher_lock:
+        if watcher_thread is None:
+            watcher_thread = threading.Thread(target=watch_library, name='library-watcher', daemon=True)
+            watcher_thread.start()
+
+# Pages are Jinja templates held in app.jinja_env's cache, so each is compiled
+# once per process rather than on every request. Their stylesheet and scripts
+# are served from /assets with a content hash in the URL: browsers keep them
+# for IMMUTABLE_MAX_AGE, and a new release changes the URL. The gallery page
+# itself is a shell without library data; its script loads that from the API.
+TEMPLATES = {
+    'setup.html': r'''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Image Gallery - Configuration Required</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f0f0f0; }
+        h1 { color: #333; }
+        .warning { color: #ff0000; font-weight: bold; }
+        .info { color: #0000ff; }
+        .code { font-family: monospace; background-color: #f0f0f0; padding: 2px 4px; }
+    </style>
+</head>
+<body>
+    <h1>Image Gallery - Configuration Required</h1>
+    <p class="warning">The SETTINGS_DIR is not configured. Please set it in the script before running.</p>
+    <p class="info">To configure the script:</p>
+    <ol>
+        <li>Open the script in a text editor.</li>
+        <li>Find the line <code class="code">SETTINGS_DIR = None</code></li>
+        <li>Replace <code class="code">None</code> with the full path to your settings directory, using a raw string (prefix with r).</li>
+        <li>Example for Unix/Linux: <code class="code">SETTINGS_DIR = r"/home/user/image_gallery_settings"</code></li>
+        <li>Example for Windows: <code class="code">SETTINGS_DIR = r"C:\Users\user\image_gallery_settings"</code></li>
+        <li>Save the script and run it again.</li>
+        <li>The script will automatically create a config.json file in the specified directory.</li>
+    </ol>
+</body>
+</html>
+''',
+    'gallery.html': r'''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Image Gallery</title>
+    <link rel="stylesheet" href="{{ asset_url('gallery.css') }}">
+</head>
+<body data-page-size="{{ page_size }}" data-prefetch="{{ prefetch }}" data-poll-interval="{{ poll_interval }}">
+    <h1>Image Gallery</h1>
+    <p><a href="{{ url_for('show_duplicates') }}">Find duplicates</a></p>
+    <div class="form-container">
+        <form method="post">
+            <textarea name="image_directories" rows="{{ [image_directories|length, 1]|max }}" placeholder="Enter full image directory paths, one per line">{{ image_directories|join('\n') }}</textarea>
+            <input type="submit" value="Update Image Directories">
+        </form>
+    </div>
+    <h2>Images from: {{ image_directories|join(', ') }}</h2>
+    <div class="sort-container">
+        <label for="sortOrder">Sort by:</label>
+        <select id="sortOrder" onchange="changeSort()">
+            <option value="name:asc">Name</option>
+            <option value="mtime:desc">Newest first</option>
+            <option value="mtime:asc">Oldest first</option>
+            <option value="dimensions:desc">Largest first</option>
+            <option value="dimensions:asc">Smallest first</option>
+        </select>
+        <input type="search" id="searchBox" placeholder="Search filenames, information and sources" oninput="scheduleSearch()">
+    </div>
+    <div class="tag-list">
+        <strong>Tags:</strong>
+    </div>
+    <div class="image-container"></div>
+    <div id="loadMoreSentinel"></div>
+
+    <div id="imageModal" class="modal">
+        <span class="close" onclick="closeModal()">&times;</span>
+        <button id="prevButton" class="nav-button" onclick="navigateImage(-1)">&lt;</button>
+        <img class="modal-content" id="modalImage">
+        <button id="nextButton" class="nav-button" onclick="navigateImage(1)">&gt;</button>
+    </div>
+
+    <script src="{{ asset_url('gallery.js') }}"></script>
+</body>
+</html>
+''',
+    'duplicates.html': r'''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Image Gallery - Duplicates</title>
+    <link rel="stylesheet" href="{{ asset_url('gallery.css') }}">
+</head>
+<body>
+    <h1>Duplicates</h1>
+    <div class="controls">
+        <a href="{{ url_for('display_images') }}">Back to gallery</a>
+        <label for="hashKind">Hash:</label>
+        <select id="hashKind" onchange="reload()">
+            {% for kind in hash_kinds %}<option value="{{ kind }}">{{ kind }}</option>{% endfor %}
+        </select>
+        <label for="distance">Max distance:</label>
+        <input type="number" id="distance" min="0" max="{{ max_distance }}" value="{{ distance }}" onchange="reload()">
+        <span id="status"></span>
+    </div>
+    <div id="clusters"></div>
+    <button id="loadMore" onclick="loadMore()" style="display: none;">Load more</button>
+
+    <script src="{{ asset_url('duplicates.js') }}"></script>
+</body>
+</html>
+'''
+}
+
+ASSETS = {
+    'gallery.css': ('text/css', r'''body { font-family: Arial, sans-serif; margin: 0; padding: 20px; background-color: #f0f0f0; }
+h1, h2 { color: #333; }
+.form-container { margin-bottom: 20px; }
+input[type="text"] { width: 300px; padding: 5px; }
+.form-container textarea { width: 300px; padding: 5px; vertical-align: bottom; }
+input[type="submit"] { padding: 5px 10px; background-color: #4CAF50; color: white; border: none; cursor: pointer; }
+.image-container { display: flex; flex-wrap: wrap; gap: 20px; }
+.image-item { 
+    background-color: white; 
+    border: 1px solid #ddd; 
+    border-radius: 4px; 
+    padding: 10px; 
+    box-shadow: 0 2px 4px rgba(0,0,0,0.1); 
+    cursor: pointer; 
+    position: relative;
+    width: 220px;
+    height: 220px;
+    display: flex;
+    flex-direction: column;
+    justify-content: center;
+    align-items: center;
+}
+.image-item img { 
+    max-width: 200px; 
+    max-height: 200px; 
+    object-fit: contain;
+}
+.image-item p { margin: 10px 0 0; text-align: center; font-size: 14px; color: #666; }
+.modal { display: none; position: fixed; z-index: 1; left: 0; top: 0; width: 100%; height: 100%; overflow: hidden; background-color: rgba(0,0,0,0.9); }
+.modal-content { position: absolute; top: 50%; left: 50%; transform: translate(-50%, -50%); max-height: 100vh; width: auto; }
+.close { position: absolute; top: 15px; right: 35px; color: #f1f1f1; font-size: 40px; font-weight: bold; cursor: pointer; }
+.menu-icon { position: absolute; top: 5px; right: 5px; background-color: rgba(255,255,255,0.7); border-radius: 50%; width: 24px; height: 24px; text-align: center; line-height: 24px; cursor: pointer; }
+.menu-content { display: none; position: absolute; top: 30px; right: 5px; background-color: white; border: 1px solid #ddd; border-radius: 4px; padding: 10px; z-index: 1; }
+.menu-content textarea, .menu-content input[type="text"] { width: 200px; margin-bottom: 5px; }
+.menu-content textarea { height: 100px; }
+.menu-content button { margin-top: 5px; }
+.menu-content label { display: block; margin-top: 5px; }
+.tag-list { margin-bottom: 20px; }
+.sort-container { margin-bottom: 10px; }
+.sort-container input[type="search"] { width: 300px; padding: 5px; margin-left: 20px; }
+.tag { display: inline-block; background-color: #e0e0e0; padding: 5px 10px; margin: 2px; border-radius: 3px; cursor: pointer; }
+.tag.active { background-color: #4CAF50; color: white; }
+.tag.excluded { background-color: #e57373; color: white; text-decoration: line-through; }
+.tag-count { font-size: 12px; opacity: 0.7; }
+.button-container { display: flex; justify-content: space-between; margin-top: 10px; }
+.button-container button { flex: 1; margin: 0 5px; }
+.nav-button {
+    position: absolute;
+    top: 50%;
+    transform: translateY(-50%);
+    background-color: rgba(255,255,255,0.5);
+    border: none;
+    font-size: 24px;
+    padding: 10px;
+    cursor: pointer;
+}
+.nav-button:hover {
+    background-color: rgba(255,255,255,0.8);
+}
+#prevButton { left: 10px; }
+#nextButton { right: 10px; }
+.tooltip { 
+    display: flex;
+    justify-content: center;
+    align-items: center;
+    width: 100%;
+    height: 100%;
+}
+.tooltip .tooltiptext { 
+    visibility: hidden; 
+    width: 120px; 
+    background-color: rgba(0, 0, 0, 0.7); 
+    color: #fff; 
+    text-align: center; 
+    border-radius: 6px; 
+    padding: 5px 0; 
+    position: absolute; 
+    z-index: 1; 
+    bottom: 100%; 
+    left: 50%; 
+    margin-left: -60px; 
+    opacity: 0; 
+    transition: opacity 0.3s;
+}
+.tooltip:hover .tooltiptext { 
+    visibility: visible; 
+    opacity: 1; 
+}
+.controls { margin-bottom: 20px; }
+.cluster { background-color: white; border: 1px solid #ddd; border-radius: 4px; padding: 10px; margin-bottom: 20px; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
+.cluster-images { display: flex; flex-wrap: wrap; gap: 20px; }
+.cluster-image { width: 200px; text-align: center; }
+.cluster-image img { max-width: 200px; max-height: 200px; object-fit: contain; }
+.cluster-image p { margin: 5px 0 0; font-size: 12px; word-break: break-all; }
+#status { color: #666; }
+'''),
+    'gallery.js': ('text/javascript', r'''// The page arrives empty and is filled from /get_images, so that it can be
+// served and cached without touching the library
+const pageSize = Number(document.body.dataset.pageSize);
+const prefetchCount = Number(document.body.dataset.prefetch);
+const pollInterval = Number(document.body.dataset.pollInterval) * 1000;
+// Room for the image on screen, its neighbours on both sides and the two
+// that were just left behind
+const viewerCacheSize = 2 * prefetchCount + 3;
+const viewerCache = new Map();
+let currentImageIndex = 0;
+// Sparse, index-aligned with the current sort order; the grid shows
+// the contiguous prefix and the modal fills in gaps on demand.
+let imageInfo = [];
+let renderedCount = 0;
+let totalImages = 0;
+let nextOffset = null;
+let sortOrder = 'name';
+let sortDirection = 'asc';
+let loadingPage = null;
+let sentinelVisible = false;
+let searchQuery = '';
+let searchTimer = null;
+let galleryGeneration = 0;
+let libraryGeneration = null;
+let eventSource = null;
+let pollTimer = null;
+const imageItems = document.getElementsByClassName('image-item');
+const sortKeys = {
+    name: image => [image.original.toLowerCase(), image.original],
+    mtime: image => [image.modified, image.original],
+    dimensions: image => [(image.width || 0) * (image.height || 0), image.original]
+};
+
+function connectEvents() {
+    let connected = false;
+    eventSource = new EventSource('/events');
+    eventSource.addEventListener('error', () => {
+        // The browser retries dropped streams by itself, but not refused ones
+        if (eventSource.readyState === EventSource.CLOSED && pollTimer === null) {
+            pollTimer = setInterval(checkForUpdates, pollInterval);
+        }
+    });
+    eventSource.addEventListener('open', () => {
+        // Anything pushed while we were disconnected is lost, so resync
+        if (connected) {
+            updateGallery();
+        }
+        connected = true;
+    });
+    eventSource.addEventListener('changes', event => applyChanges(JSON.parse(event.data)));
+    eventSource.addEventListener('resync', () => updateGallery());
+}
+
+function checkForUpdates() {
+    if (libraryGeneration === null) {
+        return;
+    }
+    fetch(`/check_updates?since=${libraryGeneration}`)
+        .then(response => response.json())
+        .then(data => {
+            if (data.updated) {
+                updateGallery();
+            }
+        });
+}
+
+function compareImages(a, b) {
+    const keyA = sortKeys[sortOrder](a);
+    const keyB = sortKeys[sortOrder](b);
+    const sign = sortDirection === 'asc' ? 1 : -1;
+    for (let i = 0; i < keyA.length; i++) {
+        if (keyA[i] < keyB[i]) return -sign;
+        if (keyA[i] > keyB[i]) return sign;
+    }
+    return 0;
+}
+
+function findImageIndex(imageId) {
+    return imageInfo.findIndex(image => image && image.original === imageId);
+}
+
+function removeImageAt(index) {
+    imageInfo.splice(index, 1);
+    imageItems[index].remove();
+    renderedCount--;
+    if (nextOffset !== null) {
+        nextOffset--;
+    }
+}
+
+function insertImage(image) {
+    let position = 0;
+    while (position < renderedCount && compareImages(imageInfo[position], image) < 0) {
+        position++;
+    }
+    if (position === renderedCount && nextOffset !== null) {
+        // Sorts after the loaded part of the grid; a later page will bring it in
+        return;
+    }
+    const emptyMessage = document.querySelector('.empty-message');
+    if (emptyMessage) {
+        emptyMessage.remove();
+    }
+    imageInfo.splice(position, 0, image);
+    document.querySelector('.image-container').insertBefore(createImageItem(image), imageItems[position] || null);
+    renderedCount++;
+    if (nextOffset !== null) {
+        nextOffset++;
+    }
+}
+
+function applyChanges(changes) {
+    const filters = tagFilters();
+    if (searchQuery || filters.all.length || filters.none.length) {
+        // The pushed totals are for the whole library; let the server
+        // recount the filtered view
+        updateGallery();
+        return;
+    }
+    // Entries fetched out of order by the modal may now be misplaced
+    imageInfo.length = renderedCount;
+    changes.removed.forEach(imageId => {
+        const index = findImageIndex(imageId);
+        if (index !== -1) {
+            removeImageAt(index);
+        }
+    });
+    changes.added.concat(changes.modified).forEach(image => {
+        const index = findImageIndex(image.original);
+        if (index !== -1) {
+            removeImageAt(index);
+        }
+        insertImage(image);
+    });
+    changes.metadata.forEach(image => {
+        const index = findImageIndex(image.original);
+        if (index !== -1) {
+            imageInfo[index] = image;
+            imageItems[index].replaceWith(createImageItem(image));
+        }
+    });
+    totalImages = changes.total;
+    libraryGeneration = changes.generation;
+    updateTagList(changes.all_tags, changes.tag_counts);
+}
+
+function tagFilters() {
+    return {
+        all: Array.from(document.querySelectorAll('.tag.active')).map(tag => tag.dataset.tag),
+        none: Array.from(document.querySelectorAll('.tag.excluded')).map(tag => tag.dataset.tag)
+    };
+}
+
+function pageUrl(offset, limit) {
+    const params = new URLSearchParams({sort: sortOrder, order: sortDirection, offset: offset, limit: limit});
+    const filters = tagFilters();
+    if (searchQuery) {
+        params.set('q', searchQuery);
+    }
+    if (filters.all.length) {
+        params.set('all', filters.all.join(','));
+    }
+    if (filters.none.length) {
+        params.set('none', filters.none.join(','));
+    }
+    return searchQuery ? `/search?${params}` : `/get_images?${params}`;
+}
+
+// Hands the parsed lines of an NDJSON response to onLines, one
+// batch per chunk as it arrives
+async function readLines(response, onLines) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const {done, value} = await reader.read();
+        buffer += decoder.decode(value, {stream: !done});
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        onLines(lines.filter(line => line).map(line => JSON.parse(line)));
+        if (done) {
+            return;
+        }
+    }
+}
+
+// Calls onImages(images, position) as images arrive and resolves
+// with the rest of the response. /get_images is read as a stream of
+// one image per line and a summary line, so the grid fills in while
+// the remainder of the page is still on its way.
+function fetchPage(offset, limit, onImages) {
+    if (searchQuery) {
+        return fetch(pageUrl(offset, limit))
+            .then(response => response.json())
+            .then(data => {
+                onImages(data.images, data.offset);
+                totalImages = data.total;
+                return data;
+            });
+    }
+    let position = offset;
+    let summary = null;
+    return fetch(pageUrl(offset, limit) + '&stream=1')
+        .then(response => readLines(response, lines => {
+            const images = [];
+            lines.forEach(line => {
+                if (line.summary) {
+                    summary = line.summary;
+                } else {
+                    images.push(line);
                 }
+            });
+            if (images.length) {
+                onImages(images, position);
+                position += images.length;
+            }
+        }))
+        .then(() => {
+            totalImages = summary.total;
+            return summary;
+        });
+}
+
+function storeImages(images, position) {
+    images.forEach((image, i) => { imageInfo[position + i] = image; });
+}
+
+function updateGallery() {
+    const generation = ++galleryGeneration;
+    let started = false;
+    // The old grid stays up until the first images of the new one arrive
+    const start = () => {
+        if (!started) {
+            started = true;
+            imageInfo = [];
+            renderedCount = 0;
+            nextOffset = null;
+            updateImageContainer([]);
+        }
+    };
+    loadingPage = null;
+    return fetchPage(0, Math.max(pageSize, renderedCount), (images, position) => {
+        // A newer search or filter has been issued since this one
+        if (generation !== galleryGeneration) {
+            return;
+        }
+        start();
+        storeImages(images, position);
+        appendImages(images);
+    }).then(data => {
+        if (generation !== galleryGeneration) {
+            return;
+        }
+        start();
+        nextOffset = data.next_offset;
+        if (renderedCount === 0) {
+            document.querySelector('.image-container').innerHTML = '<p class="empty-message">No images found in the specified directory.</p>';
+        }
+        // Search results come without library-wide tag data
+        if (data.all_tags) {
+            updateTagList(data.all_tags, data.tag_counts);
+            libraryGeneration = data.generation;
+        }
+        if (sentinelVisible) {
+            loadMore();
+        }
+    });
+}
 
-                function openModal(imageSrc) {
-                    var modal = document.getElementById("imageModal");
-                    var modalImg = document.getElementById("modalImage");
-                    modal.style.display = "block";
-                    modalImg.src = imageSrc;
-                    currentImageIndex = images.indexOf(imageSrc);
-                    
-                    modalImg.onload = function() {
-                        var aspectRatio = this.naturalWidth / this.naturalHeight;
-                        var maxHeight = window.innerHeight;
-                        var maxWidth = window.innerWidth;
-                        
-                        if (aspectRatio > maxWidth / maxHeight) {
-                            this.style.width = maxWidth + 'px';
-                            this.style.height = 'auto';
-                        } else {
-                            this.style.height = maxHeight + 'px';
-                            this.style.width = 'auto';
-                        }
+function scheduleSearch() {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => {
+        searchQuery = document.getElementById('searchBox').value.trim();
+        renderedCount = 0;
+        updateGallery();
+    }, 250);
+}
+
+function loadMore() {
+    if (nextOffset === null) {
+        return Promise.resolve();
+    }
+    if (!loadingPage) {
+        const generation = galleryGeneration;
+        let appended = true;
+        loadingPage = fetchPage(nextOffset, pageSize, (images, position) => {
+            // Only extend the grid this page was requested for
+            if (generation === galleryGeneration && position === renderedCount) {
+                storeImages(images, position);
+                appendImages(images);
+            } else {
+                appended = false;
+            }
+        })
+            .then(data => {
+                loadingPage = null;
+                if (appended && generation === galleryGeneration) {
+                    nextOffset = data.next_offset;
+                    if (sentinelVisible) {
+                        loadMore();
                     }
                 }
+            })
+            .catch(error => {
+                loadingPage = null;
+                console.error('Error:', error);
+            });
+    }
+    return loadingPage;
+}
 
-                function closeModal() {
-                    var modal = document.getElementById("imageModal");
-                    modal.style.display = "none";
-                }
+function changeSort() {
+    [sortOrder, sortDirection] = document.getElementById('sortOrder').value.split(':');
+    renderedCount = 0;
+    updateGallery();
+}
 
-                function navigateImage(direction) {
-                    currentImageIndex = (currentImageIndex + direction + images.length) % images.length;
-                    document.getElementById("modalImage").src = images[currentImageIndex];
-                }
+function updateImageContainer(newImages) {
+    const container = document.querySelector('.image-container');
+    container.innerHTML = '';
+    appendImages(newImages);
+}
 
-                function toggleMenu(imageId) {
-                    var menu = document.getElementById('menu-' + imageId);
-                    menu.style.display = menu.style.display === 'block' ? 'none' : 'block';
-                }
+function appendImages(newImages) {
+    const container = document.querySelector('.image-container');
+    const fragment = document.createDocumentFragment();
+    newImages.forEach(image => {
+        fragment.appendChild(createImageItem(image));
+        renderedCount++;
+    });
+    container.appendChild(fragment);
+}
 
-                function saveImageInfo(imageId) {
-                    var info = document.getElementById('info-' + imageId).value;
-                    var source = document.getElementById('source-' + imageId).value;
-                    var tags = document.getElementById('tags-' + imageId).value;
-                    fetch('/save_image_info', {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                        },
-                        body: JSON.stringify({
-                            image_id: imageId,
-                            info: info,
-                            source: source,
-                            tags: tags
-                        }),
-                    })
-                    .then(response => response.json())
-                    .then(data => {
-                        if (data.status === 'success') {
-                            alert('Image info saved successfully!');
-                            updateGallery();
-                        } else {
-                            alert('Failed to save image info.');
-                        }
-                    })
-                    .catch((error) => {
-                        console.error('Error:', error);
-                        alert('An error occurred while saving image info.');
-                    });
-                }
+// The grid used to be rendered by Jinja, which escaped everything it filled in
+function escapeHtml(text) {
+    return String(text).replace(/[&<>"']/g, c => `&#${c.charCodeAt(0)};`);
+}
 
-                function cancelEdit(imageId) {
-                    toggleMenu(imageId);
-                }
+function createImageItem(image) {
+    const imageItem = document.createElement('div');
+    const id = escapeHtml(image.original);
+    imageItem.className = 'image-item';
+    imageItem.dataset.id = image.original;
+    imageItem.innerHTML = `
+        <div class="tooltip">
+            <img src="${thumbUrl(image)}" alt="${escapeHtml(image.shortened)}" loading="lazy" decoding="async" onclick="openImage(this)">
+            <span class="tooltiptext">${image.dimensions}</span>
+        </div>
+        <p title="${id}">${escapeHtml(image.shortened)}</p>
+        <div class="menu-icon" onclick="toggleMenu(this.closest('.image-item').dataset.id)">⋮</div>
+        <div class="menu-content" id="menu-${id}">
+            <label for="info-${id}">Information:</label>
+            <textarea id="info-${id}">${escapeHtml(image.info)}</textarea>
+            <label for="source-${id}">Source:</label>
+            <input type="text" id="source-${id}" value="${escapeHtml(image.source)}">
+            <label for="tags-${id}">Tags (comma separated):</label>
+            <input type="text" id="tags-${id}" value="${escapeHtml(image.tags.join(', '))}">
+            <div class="button-container">
+                <button onclick="saveImageInfo(this.closest('.image-item').dataset.id)">Save</button>
+                <button onclick="cancelEdit(this.closest('.image-item').dataset.id)">Cancel</button>
+            </div>
+        </div>
+    `;
+    return imageItem;
+}
 
-                function toggleTag(tagElement) {
-                    tagElement.classList.toggle('active');
-                    filterImages();
-                }
+function updateTagList(newTags, tagCounts) {
+    const tagList = document.querySelector('.tag-list');
+    const filters = tagFilters();
+    tagList.innerHTML = '<strong>Tags:</strong> ';
+    newTags.forEach(tag => {
+        const tagSpan = document.createElement('span');
+        tagSpan.className = 'tag';
+        if (filters.all.includes(tag)) {
+            tagSpan.classList.add('active');
+        } else if (filters.none.includes(tag)) {
+            tagSpan.classList.add('excluded');
+        }
+        tagSpan.dataset.tag = tag;
+        tagSpan.textContent = tag + ' ';
+        const countSpan = document.createElement('span');
+        countSpan.className = 'tag-count';
+        countSpan.textContent = tagCounts[tag] || 0;
+        tagSpan.appendChild(countSpan);
+        tagSpan.onclick = function() { toggleTag(this); };
+        tagList.appendChild(tagSpan);
+    });
+}
 
-                function filterImages() {
-                    var activeTags = Array.from(document.querySelectorAll('.tag.active')).map(tag => tag.textContent);
-                    var images = document.querySelectorAll('.image-item');
-                    
-                    images.forEach(function(image) {
-                        var imageTags = image.dataset.tags.split(',');
-                        if (activeTags.length === 0 || activeTags.every(tag => imageTags.includes(tag))) {
-                            image.style.display = '';
-                        } else {
-                            image.style.display = 'none';
-                        }
-                    });
-                }
+// IDs are paths; keep the slashes so proxies never see an encoded one
+function imagePath(image) {
+    return image.original.split('/').map(encodeURIComponent).join('/');
+}
+
+function thumbUrl(image) {
+    return `/thumbs/${imagePath(image)}?v=${image.version}`;
+}
+
+function screenUrl(image) {
+    return `/screen/${imagePath(image)}?v=${image.version}`;
+}
+
+function getImageAt(index) {
+    if (imageInfo[index]) {
+        return Promise.resolve(imageInfo[index]);
+    }
+    if (index === renderedCount) {
+        return loadMore().then(() => imageInfo[index]);
+    }
+    return fetchPage(index, 1, storeImages).then(() => imageInfo[index]);
+}
+
+function openImage(element) {
+    openModal(findImageIndex(element.closest('.image-item').dataset.id));
+}
 
-                document.addEventListener('keydown', function(event) {
-                    if (document.getElementById("imageModal").style.display === "block") {
-                        if (event.key === "ArrowLeft") {
-                            navigateImage(-1);
-                        } else if (event.key === "ArrowRight") {
-                            navigateImage(1);
-                        } else if (event.key === "Escape") {
-                            closeModal();
-                        }
+// Shows the thumbnail, which the grid has usually loaded already, then swaps
+// in the screen-size rendition once it is decoded, and starts loading the
+// renditions of the neighbours the arrow keys lead to next
+function showImage(image, index) {
+    const modalImg = document.getElementById("modalImage");
+    modalImg.src = thumbUrl(image);
+    loadScreenImage(image).then(url => {
+        if (url && currentImageIndex === index) {
+            modalImg.src = url;
+        }
+    });
+    for (let distance = 1; distance <= prefetchCount; distance++) {
+        [index + distance, index - distance].forEach(neighbour => {
+            neighbour = (neighbour + totalImages) % totalImages;
+            if (neighbour !== index) {
+                getImageAt(neighbour).then(next => {
+                    if (next && currentImageIndex === index) {
+                        loadScreenImage(next);
                     }
                 });
+            }
+        });
+    }
+}
 
-                window.onclick = function(event) {
-                    var modal = document.getElementById("imageModal");
-                    if (event.target == modal) {
-                        modal.style.display = "none";
-                    }
-                }
+// Resolves with the rendition's URL once it is decoded, or null if it failed.
+// viewerCache is least recently used first; the Image objects are kept so the
+// browser keeps them decoded, and dropping one cancels a load still running.
+function loadScreenImage(image) {
+    const url = screenUrl(image);
+    let entry = viewerCache.get(url);
+    if (entry) {
+        viewerCache.delete(url);
+    } else {
+        const img = new Image();
+        img.src = url;
+        entry = {img: img, ready: img.decode().then(() => url, () => null)};
+    }
+    viewerCache.set(url, entry);
+    while (viewerCache.size > viewerCacheSize) {
+        const [oldestUrl, oldest] = viewerCache.entries().next().value;
+        oldest.img.src = '';
+        viewerCache.delete(oldestUrl);
+    }
+    return entry.ready;
+}
+
+function openModal(index) {
+    var modal = document.getElementById("imageModal");
+    var modalImg = document.getElementById("modalImage");
+    modal.style.display = "block";
+    currentImageIndex = index;
+    showImage(imageInfo[index], index);
 
-                // Check for updates every 5 seconds
-                setInterval(checkForUpdates, 5000);
+    modalImg.onload = function() {
+        var aspectRatio = this.naturalWidth / this.naturalHeight;
+        var maxHeight = window.innerHeight;
+        var maxWidth = window.innerWidth;
 
-                // Initial update
+        if (aspectRatio > maxWidth / maxHeight) {
+            this.style.width = maxWidth + 'px';
+            this.style.height = 'auto';
+        } else {
+            this.style.height = maxHeight + 'px';
+            this.style.width = 'auto';
+        }
+    }
+}
+
+function closeModal() {
+    var modal = document.getElementById("imageModal");
+    modal.style.display = "none";
+}
+
+function navigateImage(direction) {
+    if (totalImages === 0) {
+        return;
+    }
+    const index = (currentImageIndex + direction + totalImages) % totalImages;
+    currentImageIndex = index;
+    getImageAt(index).then(image => {
+        if (image && currentImageIndex === index) {
+            showImage(image, index);
+        }
+    });
+}
+
+function toggleMenu(imageId) {
+    var menu = document.getElementById('menu-' + imageId);
+    menu.style.display = menu.style.display === 'block' ? 'none' : 'block';
+}
+
+function saveImageInfo(imageId) {
+    var info = document.getElementById('info-' + imageId).value;
+    var source = document.getElementById('source-' + imageId).value;
+    var tags = document.getElementById('tags-' + imageId).value;
+    fetch('/save_image_info', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+            image_id: imageId,
+            info: info,
+            source: source,
+            tags: tags
+        }),
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.status === 'success') {
+            alert('Image info saved successfully!');
+            // The change comes back as a push event; only refetch without one
+            if (!eventSource || eventSource.readyState !== EventSource.OPEN) {
                 updateGallery();
-            </script>
-        </body>
-        </html>
-    ''', images=images, image_directory=config['image_directory'], all_tags=all_tags, last_modified_time=last_modified_time)
+            }
+        } else {
+            alert('Failed to save image info.');
+        }
+    })
+    .catch((error) => {
+        console.error('Error:', error);
+        alert('An error occurred while saving image info.');
+    });
+}
+
+function cancelEdit(imageId) {
+    toggleMenu(imageId);
+}
+
+function toggleTag(tagElement) {
+    // Cycles through required -> excluded -> ignored
+    if (tagElement.classList.contains('active')) {
+        tagElement.classList.replace('active', 'excluded');
+    } else if (tagElement.classList.contains('excluded')) {
+        tagElement.classList.remove('excluded');
+    } else {
+        tagElement.classList.add('active');
+    }
+    filterImages();
+}
+
+function filterImages() {
+    // Filtering happens on the server; start over from the first page
+    renderedCount = 0;
+    updateGallery();
+}
+
+document.addEventListener('keydown', function(event) {
+    if (document.getElementById("imageModal").style.display === "block") {
+        if (event.key === "ArrowLeft") {
+            navigateImage(-1);
+        } else if (event.key === "ArrowRight") {
+            navigateImage(1);
+        } else if (event.key === "Escape") {
+            closeModal();
+        }
+    }
+});
+
+window.onclick = function(event) {
+    var modal = document.getElementById("imageModal");
+    if (event.target == modal) {
+        modal.style.display = "none";
+    }
+}
 
-@app.route('/images/<filename>')
-def serve_image(filename):
+// Changes to the library are pushed by the server instead of polled
+updateGallery();
+connectEvents();
+
+// Fetch the next page whenever the end of the grid scrolls into view
+new IntersectionObserver(entries => {
+    sentinelVisible = entries.some(entry => entry.isIntersecting);
+    if (sentinelVisible) {
+        loadMore();
+    }
+}, {rootMargin: '800px'}).observe(document.getElementById('loadMoreSentinel'));
+'''),
+    'duplicates.js': ('text/javascript', r'''const pageSize = 20;
+let nextOffset = 0;
+let generation = 0;
+
+function escapeHtml(text) {
+    return String(text).replace(/[&<>"']/g, c => `&#${c.charCodeAt(0)};`);
+}
+
+function formatBytes(bytes) {
+    return bytes >= 1048576 ? `${(bytes / 1048576).toFixed(1)} MB` : `${Math.round(bytes / 1024)} KB`;
+}
+
+function imagePath(image) {
+    return image.original.split('/').map(encodeURIComponent).join('/');
+}
+
+function renderCluster(cluster) {
+    const element = document.createElement('div');
+    element.className = 'cluster';
+    element.innerHTML = `<h2>${cluster.images.length} copies, ${formatBytes(cluster.wasted_bytes)} reclaimable</h2>`;
+    const images = document.createElement('div');
+    images.className = 'cluster-images';
+    cluster.images.forEach(image => {
+        const item = document.createElement('div');
+        item.className = 'cluster-image';
+        item.innerHTML = `
+            <a href="/images/${escapeHtml(imagePath(image))}?v=${escapeHtml(image.version)}" target="_blank">
+                <img src="/thumbs/${escapeHtml(imagePath(image))}?v=${escapeHtml(image.version)}" alt="${escapeHtml(image.shortened)}" loading="lazy">
+            </a>
+            <p title="${escapeHtml(image.original)}">${escapeHtml(image.original)}<br>${escapeHtml(image.dimensions)}</p>
+        `;
+        images.appendChild(item);
+    });
+    element.appendChild(images);
+    return element;
+}
+
+function loadMore() {
+    const current = generation;
+    const params = new URLSearchParams({
+        hash: document.getElementById('hashKind').value,
+        distance: document.getElementById('distance').value,
+        offset: nextOffset,
+        limit: pageSize
+    });
+    fetch(`/get_duplicates?${params}`)
+        .then(response => response.json())
+        .then(data => {
+            if (current !== generation) return;
+            if (data.status === 'error') {
+                document.getElementById('status').textContent = data.message;
+                return;
+            }
+            if (data.status === 'pending') {
+                // Grouping runs in the background; ask again until it is done
+                const job = data.job;
+                let status = job.total ? `Grouping images, ${job.progress} of ${job.total}` : 'Grouping images';
+                if (data.pending) {
+                    status += `, ${data.pending} still being hashed`;
+                }
+                document.getElementById('status').textContent = status;
+                setTimeout(() => {
+                    if (current === generation) loadMore();
+                }, 1000);
+                return;
+            }
+            const container = document.getElementById('clusters');
+            data.clusters.forEach(cluster => container.appendChild(renderCluster(cluster)));
+            nextOffset = data.next_offset;
+            document.getElementById('loadMore').style.display = nextOffset === null ? 'none' : '';
+            let status = `${data.total} groups among ${data.hashed} images`;
+            if (data.pending) {
+                status += `, ${data.pending} still being hashed`;
+            }
+            document.getElementById('status').textContent = status;
+        });
+}
+
+function reload() {
+    generation++;
+    nextOffset = 0;
+    document.getElementById('clusters').innerHTML = '';
+    loadMore();
+}
+
+reload();
+''')
+}
+
+asset_versions = {name: hashlib.sha256(body.encode('utf-8')).hexdigest()[:16] for name, (_, body) in ASSETS.items()}
+
+app.jinja_loader = DictLoader(TEMPLATES)
+
+@app.template_global()
+def asset_url(name):
+    return url_for('serve_asset', name=name, v=asset_versions[name])
+
+def precompile_templates():
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if PROFILE_REQUESTS and 'profile' in request.args:
+        # One profiled request at a time; cProfile cannot run two at once
+        if not profile_lock.acquire(blocking=False):
+            return "Another request is being profiled", 409
+        if pyinstrument is not None and request.args['profile'] == 'pyinstrument':
+            g.profiler = pyinstrument.Profiler()
+            g.profiler.start()
+        else:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    if 'render_start' in g:
+        record_phase('render', time.perf_counter() - g.pop('render_start'))
+
+@app.after_request
+def add_server_timing(response):
+    for phase, seconds in g.get('phase_seconds', {}).items():
+        response.headers.add('Server-Timing', f"{phase};desc=\"{TIMED_PHASES[phase]}\";dur={seconds * 1000:.3f}")
+    if 'request_start' in g:
+        # For streamed responses this is the time to the first byte
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        observe_metric('gallery_request_duration_seconds', time.perf_counter() - g.request_start,
+                       route=route, method=request.method, status=str(response.status_code))
+    if 'profiler' in g:
+        return get_profile_response(response)
+    return response
+
+@app.teardown_request
+def stop_profiler(exc):
+    # A handler that raised never reaches after_request
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+        else:
+            profiler.stop()
+        profile_lock.release()
+
+def get_profile_response(response):
+    # Runs a streamed body to the end so that it is part of the profile, then
+    # replaces the response with the report. An event stream never ends, so
+    # it goes out unprofiled rather than holding profile_lock forever.
+    if response.mimetype == 'text/event-stream':
+        stop_profiler(None)
+        return response
+    if response.is_streamed and not response.direct_passthrough:
+        response.make_sequence()
+    profiler = g.pop('profiler')
+    try:
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            return Response(report.getvalue(), mimetype='text/plain')
+        profiler.stop()
+        return Response(profiler.output_html(), mimetype='text/html')
+    finally:
+        profile_lock.release()
+
+@app.route('/', methods=['GET', 'POST'])
+def display_images():
+    if SETTINGS_DIR is None:
+        return render_template('setup.html')
+    
     config = load_config()
-    if config and 'image_directory' in config:
-        return send_from_directory(config['image_directory'], secure_filename(filename))
-    return "Configuration error", 500
+    if config is None:
+        return "Failed to load or create configuration. Please check your settings directory permissions."
+
+    if request.method == 'POST':
+        # One directory per line; the first becomes image_directory. Moving a
+        # directory to another line changes the IDs of the images below it.
+        new_image_dirs = request.form.get('image_directories', request.form.get('image_directory', '')).splitlines()
+        new_image_dirs = [directory.strip() for directory in new_image_dirs if directory.strip()]
+        for new_image_dir in new_image_dirs or ['']:
+            if not os.path.isdir(new_image_dir):
+                return f"The directory '{new_image_dir}' does not exist. Please enter a valid directory path."
+        if len(set(new_image_dirs)) != len(new_image_dirs):
+            return "Each directory can only be listed once."
+        def set_image_directories(config):
+            config['image_directory'] = new_image_dirs[0]
+            config['extra_directories'] = new_image_dirs[1:]
+        config = update_config(set_image_directories)
+        notify_library_changed()
+
+    roots = get_library_roots(config)
+    return render_template('gallery.html', page_size=PAGE_SIZE, prefetch=VIEWER_PREFETCH, poll_interval=EVENT_POLL_INTERVAL, image_directories=[root for root in roots if root])
+
+def is_not_modified(etag, mtime):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
+def set_cache_headers(response, version, max_age):
+    response.cache_control.public = True
+    response.cache_control.no_cache = None
+    if request.args.get('v') == version:
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    elif max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+@app.route('/assets/<name>')
+def serve_asset(name):
+    if name not in ASSETS:
+        return "Not found", 404
+    version = asset_versions[name]
+    if request.if_none_match.contains(version):
+        response = app.response_class(status=304)
+    else:
+        mimetype, body = ASSETS[name]
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(version)
+    return set_cache_headers(response, version, 0)
+
+@app.route('/images/<path:image_id>')
+def serve_image(image_id):
+    config = load_config()
+    if not config or 'image_directory' not in config:
+        return "Configuration error", 500
+
+    location = resolve_image_path(config, image_id)
+    if location is None or get_indexed_size(location[0], location[1]) is None:
+        return "Not found", 404
+    file_path = location[2]
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return "Not found", 404
+
+    # Validators come from the stat result alone, so a revalidation is answered
+    # without opening the file. Range and If-Range are handled by send_file.
+    version = get_file_version(st.st_size, st.st_mtime_ns, st.st_ino)
+    if is_not_modified(version, st.st_mtime):
+        response = app.response_class(status=304)
+        response.set_etag(version)
+        response.last_modified = st.st_mtime
+    else:
+        response = send_file(file_path, conditional=True, etag=version, last_modified=st.st_mtime)
+    return set_cache_headers(response, version, 0)
+
+@app.route('/thumbs/<path:image_id>')
+def serve_thumbnail(image_id):
+    return serve_rendition(image_id, THUMBNAIL_SIZE)
+
+@app.route('/screen/<path:image_id>')
+def serve_screen_image(image_id):
+    return serve_rendition(image_id, SCREEN_SIZE)
+
+def serve_rendition(image_id, size):
+    config = load_config()
+    if not config or 'image_directory' not in config:
+        return "Configuration error", 500
+
+    location = resolve_image_path(config, image_id)
+    row = None if location is None else get_indexed_size(location[0], location[1])
+    if row is None:
+        return "Not found", 404
+    file_path = location[2]
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return "Not found", 404
+
+    version = get_file_version(st.st_size, st.st_mtime_ns, st.st_ino)
+    if size == SCREEN_SIZE and fits_screen(row):
+        return set_cache_headers(redirect(url_for('serve_image', image_id=image_id, v=version)), version, THUMBNAIL_MAX_AGE)
+    kind = 'thumbnail' if size == THUMBNAIL_SIZE else 'screen'
+    key = get_thumbnail_key(file_path, st, size)
+    if request.if_none_match.contains(key):
+        response = app.response_class(status=304)
+    else:
+        # Misses are rendered on the job pool, where they go ahead of probing
+        # and hashing, and requests for a rendition already queued share its job
+        thumbnail_path = get_cached_thumbnail(key)
+        count_metric('gallery_cache_requests_total', cache=f'{kind}s', result='miss' if thumbnail_path is None else 'hit')
+        if thumbnail_path is None:
+            job = submit_job(kind, lambda job: get_thumbnail(file_path, st, key, size),
+                             key=f'{kind}:{key}', priority=JOB_PRIORITY_HIGH, description=image_id)
+            thumbnail_path = wait_for_job(job, THUMBNAIL_WAIT)
+        if thumbnail_path is None:
+            return redirect(url_for('serve_image', image_id=image_id))
+        response = send_file(thumbnail_path, mimetype=f"image/{THUMBNAIL_FORMAT.lower()}", conditional=False, etag=False, max_age=THUMBNAIL_MAX_AGE)
+    response.set_etag(key)
+    return set_cache_headers(response, version, THUMBNAIL_MAX_AGE)
 
 @app.route('/save_image_info', methods=['POST'])
 def save_image_info():
@@ -493,41 +3419,409 @@ def save_image_info():
     if not image_id or info is None or source is None or tags is None:
         return jsonify({"status": "error", "message": "Invalid data"}), 400
 
-    if 'image_info' not in config:
-        config['image_info'] = {}
-
-    config['image_info'][image_id] = {
-        'info': info,
-        'source': source,
-        'tags': tags
-    }
-    save_config(config)
+    def set_image_info(config):
+        if 'image_info' not in config:
+            config['image_info'] = {}
+        config['image_info'][image_id] = {
+            'info': info,
+            'source': source,
+            'tags': tags
+        }
+        set_image_tags(config['image_info'], image_id, tags)
+    config = update_config(set_image_info)
+    location = resolve_image_path(config, image_id)
+    if location is not None:
+        set_search_text(location[0], location[1], info, source, tags)
+    advance_library_generation()
+    notify_library_changed()
 
     return jsonify({"status": "success"})
 
+@app.route('/bulk_edit', methods=['POST'])
+def bulk_edit():
+    # {"edits": [{"image_ids": [...], "add_tags": [...], ...}, ...]}. Every
+    # edit is checked before any is applied, and all of them land in a single
+    # config write.
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('edits'), list):
+        return jsonify({"status": "error", "message": "Expected a JSON object with a list of edits"}), 400
+    try:
+        edits = [parse_image_edit(edit) for edit in data['edits']]
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    changed = save_image_edits(edits)
+    if changed is None:
+        return jsonify({"status": "error", "message": "Failed to load configuration"}), 500
+    return jsonify({"status": "success", "updated": len(changed)})
+
+@app.route('/export_image_info')
+def export_image_info_route():
+    config = load_config()
+    if config is None:
+        return jsonify({"status": "error", "message": "Failed to load configuration"}), 500
+
+    file_format = request.args.get('format', 'jsonl')
+    if file_format not in ('jsonl', 'csv'):
+        return jsonify({"status": "error", "message": f"Unknown format '{file_format}'"}), 400
+    mimetype = 'text/csv' if file_format == 'csv' else 'application/x-ndjson'
+    return Response(export_image_info(dict(config.get('image_info', {})), file_format), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=image_info.{file_format}'})
+
+@app.route('/import_image_info', methods=['POST'])
+def import_image_info():
+    # Takes the export formats back, either as the request body or as an
+    # uploaded file. Fields a row leaves out keep their current value, and a
+    # bad row rejects the whole import.
+    file_format = request.args.get('format', 'jsonl')
+    if file_format not in ('jsonl', 'csv'):
+        return jsonify({"status": "error", "message": f"Unknown format '{file_format}'"}), 400
+    stream = request.files['file'].stream if 'file' in request.files else io.BufferedReader(request.stream)
+
+    edits = []
+    try:
+        for line_number, row in read_image_info_rows(stream, file_format):
+            try:
+                edits.append(parse_image_edit(row))
+            except ValueError as e:
+                return jsonify({"status": "error", "message": f"Line {line_number}: {e}"}), 400
+    except (ValueError, csv.Error) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    changed = save_image_edits(edits)
+    if changed is None:
+        return jsonify({"status": "error", "message": "Failed to load configuration"}), 500
+    return jsonify({"status": "success", "rows": len(edits), "updated": len(changed)})
+
 @app.route('/get_images')
 def get_images():
     config = load_config()
     if config is None:
         return jsonify({"status": "error", "message": "Failed to load configuration"}), 500
 
-    images, all_tags = get_images_from_directory(config['image_directory'], config.get('image_info', {}))
-    last_modified_time = get_directory_modified_time(config['image_directory'])
-    return jsonify({"images": images, "all_tags": all_tags, "last_modified_time": last_modified_time})
+    try:
+        sort, order, offset, limit = get_page_arguments(request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    image_info = config.get('image_info', {})
+    if request.args.get('stream'):
+        return Response(stream_library_page(get_library_roots(config), image_info, sort, order, offset, limit,
+                                            get_tag_filters(request.args)),
+                        mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+    generation = get_library_generation()
+    images, all_tags = get_library_images(get_library_roots(config), image_info)
+    last_modified_time = last_scan['modified_time']
+    tag_counts = count_tags(last_scan['images'], image_info)
+    all_filter, any_filter, none_filter = get_tag_filters(request.args)
+    if all_filter or any_filter or none_filter:
+        matches = query_tags(image_info, last_scan['images'], all_filter, any_filter, none_filter)
+        images = [image for image in images if image.original in matches]
+    page, next_offset = paginate_images(images, sort, order, offset, limit)
+    return jsonify({
+        "images": [image.as_dict() for image in page],
+        "all_tags": all_tags,
+        "tag_counts": tag_counts,
+        "total": len(images),
+        "offset": offset,
+        "next_offset": next_offset,
+        "last_modified_time": last_modified_time,
+        "generation": generation
+    })
+
+@app.route('/query_tags')
+def query_tags_route():
+    config = load_config()
+    if config is None:
+        return jsonify({"status": "error", "message": "Failed to load configuration"}), 500
+
+    all_filter, any_filter, none_filter = get_tag_filters(request.args)
+    limit = request.args.get('limit', None, type=int)
+    image_info = config.get('image_info', {})
+    roots = get_library_roots(config)
+    if last_scan['roots'] != tuple(roots):
+        get_library_images(roots, image_info)
+
+    start = time.perf_counter()
+    matches = query_tags(image_info, last_scan['images'], all_filter, any_filter, none_filter)
+    tag_counts = count_tags(matches, image_info)
+    elapsed = time.perf_counter() - start
+    return jsonify({
+        "images": sorted(matches)[:limit],
+        "total": len(matches),
+        "tag_counts": tag_counts,
+        "query_ms": round(elapsed * 1000, 3)
+    })
+
+@app.route('/search')
+def search():
+    config = load_config()
+    if config is None:
+        return jsonify({"status": "error", "message": "Failed to load configuration"}), 500
+
+    try:
+        sort, order, offset, limit = get_page_arguments(request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    start = time.perf_counter()
+    image_info = config.get('image_info', {})
+    roots = get_library_roots(config)
+    with time_phase('search'):
+        rows, total = search_images(roots, image_info, request.args.get('q', ''),
+                                    offset, limit, get_tag_filters(request.args))
+    image_tags = get_tags_by_image(image_info)
+    prefixes = get_root_prefixes(roots)
+    page = [make_image_record(make_image_id(prefixes[row['directory']], row['filename']), row, image_info, image_tags).as_dict() for row in rows]
+    end = offset + len(page)
+    elapsed = time.perf_counter() - start
+    return jsonify({
+        "images": page,
+        "total": total,
+        "offset": offset,
+        "next_offset": end if end < total else None,
+        "query_ms": round(elapsed * 1000, 3)
+    })
+
+@app.route('/get_duplicates')
+def get_duplicates():
+    config = load_config()
+    if config is None:
+        return jsonify({"status": "error", "message": "Failed to load configuration"}), 500
+
+    kind = request.args.get('hash', 'phash')
+    max_distance = request.args.get('distance', DUPLICATE_DISTANCE, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', None, type=int)
+    if kind not in HASH_KINDS:
+        return jsonify({"status": "error", "message": f"Unknown hash '{kind}'"}), 400
+    if not 0 <= max_distance <= MAX_DUPLICATE_DISTANCE:
+        return jsonify({"status": "error", "message": f"distance must be between 0 and {MAX_DUPLICATE_DISTANCE}"}), 400
+    if offset < 0 or (limit is not None and limit < 0):
+        return jsonify({"status": "error", "message": "offset and limit must not be negative"}), 400
+
+    start = time.perf_counter()
+    roots = get_library_roots(config)
+    pending = count_pending_images(roots, 'phash')
+    if pending:
+        request_hashes()
+    clusters, hashed, job = get_duplicate_clusters(roots, kind, max_distance)
+    if clusters is None:
+        with job_condition:
+            status = get_job_status(job)
+        if status['state'] == 'failed':
+            return jsonify({"status": "error", "message": status['error']}), 500
+        return jsonify({
+            "status": "pending",
+            "job": status,
+            "pending": pending,
+            "query_ms": round((time.perf_counter() - start) * 1000, 3)
+        })
+
+    image_info = config.get('image_info', {})
+    image_tags = get_tags_by_image(image_info)
+    end = len(clusters) if limit is None else min(offset + limit, len(clusters))
+    page = []
+    conn = open_index()
+    try:
+        for cluster in clusters[offset:end]:
+            # An image deleted since the clusters were grouped is left out
+            rows = {}
+            for image_id in cluster:
+                index, filename = split_image_id(image_id, len(roots))
+                row = conn.execute('SELECT * FROM images WHERE directory = ? AND filename = ?', (roots[index], filename)).fetchone()
+                if row is not None:
+                    rows[image_id] = row
+            if len(rows) < 2:
+                continue
+            # Largest copy first, as the one most worth keeping
+            members = sorted(rows, key=lambda image_id: ((rows[image_id]['width'] or 0) * (rows[image_id]['height'] or 0), rows[image_id]['size']), reverse=True)
+            sizes = [rows[image_id]['size'] for image_id in members]
+            page.append({
+                "images": [make_image_record(image_id, rows[image_id], image_info, image_tags).as_dict() for image_id in members],
+                "wasted_bytes": sum(sizes) - sizes[0]
+            })
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - start
+    return jsonify({
+        "clusters": page,
+        "total": len(clusters),
+        "offset": offset,
+        "next_offset": end if end < len(clusters) else None,
+        "hashed": hashed,
+        "pending": pending,
+        "query_ms": round(elapsed * 1000, 3)
+    })
+
+@app.route('/duplicates')
+def show_duplicates():
+    return render_template('duplicates.html', hash_kinds=HASH_KINDS, distance=DUPLICATE_DISTANCE, max_distance=MAX_DUPLICATE_DISTANCE)
+
+@app.route('/jobs')
+def list_jobs():
+    state = request.args.get('state')
+    with job_condition:
+        statuses = [get_job_status(job) for job in jobs.values() if state is None or job['state'] == state]
+        states = Counter(job['state'] for job in jobs.values())
+    return jsonify({
+        "jobs": statuses,
+        "queued": states['queued'],
+        "running": states['running'],
+        "workers": JOB_WORKERS
+    })
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(get_job_status(job))
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job_route(job_id):
+    job = cancel_job(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Unknown job"}), 404
+    return jsonify(get_job_status(job))
+
+@app.route('/events')
+def events():
+    ensure_watcher()
+    subscriber = subscribe()
+    if subscriber is None:
+        # Any answer but an event stream makes EventSource give up for good,
+        # and the page falls back to polling
+        count_metric('gallery_event_streams_refused_total')
+        return "Too many open event streams", 503
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event_type, data = subscriber.get(timeout=EVENT_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/check_updates')
 def check_updates():
-    global last_modified_time
     config = load_config()
     if config is None:
         return jsonify({"status": "error", "message": "Failed to load configuration"}), 500
 
-    current_modified_time = get_directory_modified_time(config['image_directory'])
-    if current_modified_time > last_modified_time:
-        last_modified_time = current_modified_time
+    since = request.args.get('since', type=int)
+    if since is not None:
+        # Pages polling instead of listening on /events send the generation
+        # they were built from. Folder mtimes alone would miss dimensions
+        # probed after the page loaded and info saved from other tabs, so the
+        # folders that changed are indexed here, which moves the generation.
+        for index, root in enumerate(get_library_roots(config)):
+            if root and os.path.isdir(root):
+                update_index(root, get_root_prefix(index), config.get('image_info', {}))
+        return jsonify({"updated": get_library_generation() > since})
+    current_modified_time = get_library_modified_time(get_library_roots(config))
+    if current_modified_time is not None and advance_state('last_modified_time', current_modified_time):
         return jsonify({"updated": True})
     else:
         return jsonify({"updated": False})
 
+@app.route('/metrics')
+def metrics():
+    if not METRICS_ENABLED:
+        return "Metrics are disabled", 404
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the image gallery.")
+    parser.add_argument('--host', default=os.environ.get('GALLERY_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('GALLERY_PORT', 5005)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('GALLERY_WORKERS', 1)),
+                        help="number of worker processes (gunicorn only)")
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('GALLERY_THREADS', 8)),
+                        help="number of request threads per worker")
+    parser.add_argument('--settings-dir', default=os.environ.get('GALLERY_SETTINGS_DIR'),
+                        help="overrides SETTINGS_DIR")
+    parser.add_argument('--server', choices=('auto', 'waitress', 'gunicorn', 'dev'), default=os.environ.get('GALLERY_SERVER', 'auto'),
+                        help="auto picks gunicorn for several workers, then waitress, then Flask's development server")
+    parser.add_argument('--debug', action='store_true',
+                        help="run Flask's development server with the reloader and debugger")
+    parser.add_argument('--event-streams', type=int, default=EVENT_STREAM_LIMIT,
+                        help="open tabs per worker that get changes pushed to them (default half of --threads); "
+                             "the others check for changes every few seconds")
+    parser.add_argument('--prefetch', type=int, default=VIEWER_PREFETCH,
+                        help="images on either side of the one open in the viewer to load ahead of time")
+    parser.add_argument('--no-metrics', action='store_true', default=not METRICS_ENABLED,
+                        help="stop collecting metrics and serving /metrics")
+    parser.add_argument('--profile', action='store_true', default=PROFILE_REQUESTS,
+                        help="let ?profile on any URL return a profile of the request")
+    return parser.parse_args(argv)
+
+def choose_server(args):
+    if args.debug:
+        return 'dev'
+    if args.server != 'auto':
+        return args.server
+    has_gunicorn = importlib.util.find_spec('gunicorn') is not None
+    if args.workers > 1 and has_gunicorn:
+        return 'gunicorn'
+    if importlib.util.find_spec('waitress') is not None:
+        return 'waitress'
+    if has_gunicorn:
+        return 'gunicorn'
+    return 'dev'
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class GalleryApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{args.host}:{args.port}")
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            # Threaded workers keep an /events stream from tying up a whole
+            # process, though it still takes one of its threads
+            self.cfg.set('worker_class', 'gthread')
+
+        def load(self):
+            return app
+
+    GalleryApplication().run()
+
+def serve(args):
+    global SETTINGS_DIR, METRICS_ENABLED, PROFILE_REQUESTS, VIEWER_PREFETCH, EVENT_STREAM_LIMIT
+    if args.settings_dir:
+        SETTINGS_DIR = args.settings_dir
+        os.environ['GALLERY_SETTINGS_DIR'] = args.settings_dir
+    METRICS_ENABLED = not args.no_metrics
+    VIEWER_PREFETCH = args.prefetch
+    PROFILE_REQUESTS = args.profile
+
+    # Compiled before gunicorn forks, so the workers inherit them
+    precompile_templates()
+    server = choose_server(args)
+    if args.event_streams is not None:
+        EVENT_STREAM_LIMIT = args.event_streams
+    elif server != 'dev':
+        EVENT_STREAM_LIMIT = args.threads // 2
+    if server != 'gunicorn' and args.workers > 1:
+        print(f"--workers is only supported with gunicorn; {server} runs a single process")
+    if server == 'gunicorn':
+        run_gunicorn(args)
+    elif server == 'waitress':
+        from waitress import serve as waitress_serve
+        print(f"Serving on http://{args.host}:{args.port} with waitress ({args.threads} threads)")
+        waitress_serve(app, host=args.host, port=args.port, threads=args.threads)
+    else:
+        if not args.debug:
+            print("Neither waitress nor gunicorn is installed; falling back to Flask's development server")
+        app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
+
 if __name__ == '__main__':
-    app.run(debug=True, port=5005)
\ No newline at end of file
+    serve(parse_args())
\ No newline at end of file